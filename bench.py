@@ -0,0 +1,226 @@
+# Offline benchmark: replays scripted sessions through process_action/handle_all against a
+# fake Telegram Bot API (local HTTP server that records every call) and mongomock as an
+# in-process MongoDB, then reports latency percentiles and Mongo round trips per action.
+#
+#   pip install mongomock
+#   python bench.py --tickets 2000 --rounds 50 > bench_output.txt
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+try:
+    import mongomock
+except ImportError:
+    sys.exit("bench.py needs mongomock: pip install mongomock")
+import pymongo
+import telebot
+from telebot import types
+
+# --- FAKE BOT API ---
+class FakeTelegram(BaseHTTPRequestHandler):
+    calls = []
+    message_id = 1000
+    updates = []  # served by getUpdates until confirmed through `offset`, like the real API
+
+    def do_POST(self):
+        method = urlparse(self.path).path.rsplit("/", 1)[-1]
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length).decode(errors="replace") if length else ""
+        params = dict(parse_qsl(urlparse(self.path).query))
+        if body and "json" in (self.headers.get("Content-Type") or ""): params.update(json.loads(body))
+        elif body and "form-data" not in (self.headers.get("Content-Type") or ""): params.update(parse_qsl(body))
+        FakeTelegram.calls.append(method)
+        data = json.dumps({"ok": True, "result": self.result(method, params)}).encode()
+        self.send_response(200); self.send_header("Content-Type", "application/json"); self.send_header("Content-Length", str(len(data))); self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST
+
+    def result(self, method, params):
+        if method in ("answerCallbackQuery", "deleteMessage", "deleteWebhook", "setWebhook"): return True
+        if method == "getMe": return {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method == "getUpdates":
+            offset = int(params.get("offset", 0))
+            FakeTelegram.updates = [u for u in FakeTelegram.updates if u["update_id"] >= offset]
+            if not FakeTelegram.updates: time.sleep(0.2)
+            return FakeTelegram.updates[:100]
+        FakeTelegram.message_id += 1
+        msg = {"message_id": FakeTelegram.message_id, "date": int(time.time()), "chat": {"id": int(params.get("chat_id", 0)), "type": "private"}}
+        return [msg] if method == "sendMediaGroup" else msg
+
+    def log_message(self, *args): pass
+
+def start_fake_telegram():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeTelegram)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+# --- MONGO STAND-IN ---
+# Every collection call below is one round trip against a real server. mongomock implements
+# some of them on top of others (find_one -> find), so only the outermost call is counted.
+ROUND_TRIPS = ["find", "find_one", "find_one_and_update", "update_one", "update_many", "insert_one", "insert_many",
+               "delete_one", "delete_many", "count_documents", "aggregate", "bulk_write", "replace_one", "distinct"]
+mongo_calls = threading.local()
+
+def count_round_trips():
+    for name in ROUND_TRIPS:
+        orig = getattr(mongomock.Collection, name)
+        def wrapped(self, *args, _orig=orig, **kwargs):
+            depth = getattr(mongo_calls, 'depth', 0)
+            if not depth: mongo_calls.n = getattr(mongo_calls, 'n', 0) + 1
+            mongo_calls.depth = depth + 1
+            try: return _orig(self, *args, **kwargs)
+            finally: mongo_calls.depth = depth
+        setattr(mongomock.Collection, name, wrapped)
+
+# Bot API calls per action: requests made on the action's own thread plus notifications it
+# queued on the outbox (those are sent later by the outbox workers).
+tg_calls = threading.local()
+
+def count_telegram(main):
+    make_request, send = telebot.apihelper._make_request, main.outbox.send
+    def counted_request(*args, **kwargs):
+        tg_calls.n = getattr(tg_calls, 'n', 0) + 1
+        return make_request(*args, **kwargs)
+    def counted_send(*args, **kwargs):
+        tg_calls.n = getattr(tg_calls, 'n', 0) + 1
+        return send(*args, **kwargs)
+    telebot.apihelper._make_request = counted_request; main.outbox.send = counted_send
+
+def load_bot():
+    os.environ["BOT_TOKEN"] = "123456:bench"; os.environ["ADMIN_ID"] = "1"
+    client = mongomock.MongoClient()
+    pymongo.MongoClient = lambda *a, **k: client
+    port = start_fake_telegram()
+    telebot.apihelper.API_URL = f"http://127.0.0.1:{port}/bot{{0}}/{{1}}"
+    import main
+    if not main.db_ready.wait(10): sys.exit("mongo stand-in did not come up")
+    return main
+
+# --- SEEDING ---
+def seed(main, tickets, users, heavy_share):
+    rnd = random.Random(7); base = datetime.now() - timedelta(days=20); n = 0
+    for s in main.CATEGORIES.values():
+        slug = s['slug']; docs = []; summary = {}
+        for _ in range(tickets):
+            n += 1
+            uid = 500 if rnd.random() < heavy_share else 1000 + rnd.randrange(users)
+            created = base + timedelta(seconds=rnd.randrange(20 * 86400))
+            history = [{'role': 'admin' if i % 2 else 'user', 'text': f"message {i} " * rnd.randint(1, 8), 'time': created + timedelta(minutes=i), 'index': i + 1} for i in range(rnd.randrange(30))]
+            for h in history:
+                if rnd.random() < 0.1: h['photo'] = f"photo-{n}-{h['index']}"
+            t = {'_id': f"seed/{n}", 'user_id': uid, 'name': f"User {uid}", 'username': f"user{uid}", 'text': "seeded issue", 'status': 'resolved' if rnd.random() < 0.7 else 'open',
+                 'created_at': created, 'history': history, 'history_len': len(history), 'last_role': history[-1]['role'] if history else 'user'}
+            if t['status'] == 'resolved': t['resolved_at'] = created + timedelta(hours=1)
+            if rnd.random() < 0.2: t['photo'] = f"photo-{n}-0"
+            t['media'] = [m for m in [main.media_entry(0, t)] + [main.media_entry(h['index'], h) for h in history] if m]
+            docs.append(t)
+            u = summary.setdefault(uid, {'_id': uid, 'name': t['name'], 'username': t['username'], 'last_activity': created, 'open_count': 0})
+            u['last_activity'] = max(u['last_activity'], created); u['open_count'] += t['status'] == 'open'
+        main.get_ticket_col(slug).insert_many(docs); main.get_summary_col(slug).insert_many(list(summary.values()))
+    main.settings_col.update_one({"_id": "ticket_counter"}, {"$set": {"count": n}}, upsert=True)
+
+# --- SESSIONS ---
+ADMIN = 1
+update_ids = iter(range(1, 10 ** 9))
+
+def message(uid, text, photo=None):
+    d = {"message_id": next(update_ids), "date": 0, "chat": {"id": uid, "type": "private"}, "from": {"id": uid, "is_bot": False, "first_name": f"U{uid}", "username": f"user{uid}"}}
+    if photo: d.update(photo=[{"file_id": photo, "file_unique_id": photo, "width": 1, "height": 1}], caption=text)
+    else: d["text"] = text
+    return types.Message.de_json(d)
+
+class Recorder:
+    def __init__(self): self.samples = {}
+
+    def run(self, name, fn, *args):
+        mongo_calls.n = tg_calls.n = 0; started = time.perf_counter()
+        fn(*args)
+        self.samples.setdefault(name, []).append((time.perf_counter() - started, mongo_calls.n, tg_calls.n))
+
+    def report(self):
+        print(f"{'action':<22}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'mongo/op':>10}{'tg/op':>8}")
+        for name, rows in self.samples.items():
+            lat = sorted(r[0] * 1000 for r in rows)
+            pct = lambda p: lat[min(len(lat) - 1, int(p * len(lat)))]
+            print(f"{name:<22}{len(rows):>6}{pct(0.5):>10.2f}{pct(0.95):>10.2f}{pct(0.99):>10.2f}{sum(r[1] for r in rows) / len(rows):>10.1f}{sum(r[2] for r in rows) / len(rows):>8.1f}")
+
+def session(main, rec, rnd, uid):
+    pa = lambda action, who=ADMIN: main.process_action(action, who, who, 1, "cb")
+    slug = rnd.choice([s['slug'] for s in main.CATEGORIES.values()])
+    rec.run("create_ticket", lambda: (pa(f"cat|{slug}", uid), main.handle_all(message(uid, "it broke", photo="p" if rnd.random() < 0.3 else None))))
+    rec.run("admin_user_list", pa, f"adm_cat|{slug}")
+    rec.run("admin_user_list_p2", pa, f"u_list|{slug}|2")
+    rec.run("admin_user_tickets", pa, f"u_tix|{slug}|500|1|resolved")
+    for p in range(2, 6): rec.run("deep_page_next", pa, f"u_tix|{slug}|500|{p}|resolved")
+    total = main.user_states.get(ADMIN, {}).get('list_config', {}).get('total', 1)
+    rec.run("deep_page_jump", pa, f"u_tix|{slug}|500|{total}|resolved")
+    tid = main.get_ticket_col(slug).find_one({"user_id": uid, "status": "open"}, {"_id": 1}, sort=[("created_at", -1)])['_id']
+    rec.run("ticket_view", pa, f"t_view|{slug}|{tid}|{uid}|1|open")
+    rec.run("admin_reply", lambda: (pa(f"t_rep|{slug}|{tid}|{uid}|1|open"), main.handle_all(message(ADMIN, "on it", photo="a" if rnd.random() < 0.3 else None))))
+    rec.run("user_reply", lambda: (pa(f"u_rep|{slug}|{tid}", uid), main.handle_all(message(uid, "thanks"))))
+    rec.run("self_tickets", pa, "self_tix|1|open", uid)
+    rec.run("self_view", pa, f"self_view|{slug}|{tid}", uid)
+    heavy = main.get_ticket_col(slug).find_one({"user_id": 500, "history.photo": {"$exists": True}}, {"_id": 1})
+    if heavy: rec.run("view_all_media", pa, f"v_all_med|{slug}|{heavy['_id']}")
+    rec.run("resolve", pa, f"t_res|{slug}|{tid}|{uid}|1|open")
+
+def polling(main, n):
+    # Feeds callbacks through getUpdates to infinity_polling, as in production, with handlers slow
+    # enough that updates are still queued on the workers when the next getUpdates goes out.
+    # Every callback must be handled exactly once.
+    seen = []; process = main.process_action
+    def slow(action, uid, chat_id, msg_id, call_id, *args, **kwargs):
+        if action == "ignore": seen.append(call_id); time.sleep(0.02)
+        return process(action, uid, chat_id, msg_id, call_id, *args, **kwargs)
+    main.process_action = slow
+    for i in range(n):
+        cb = {"id": f"poll-{i}", "from": {"id": 77, "is_bot": False, "first_name": "x"}, "chat_instance": "b", "data": "ignore", "message": {"message_id": 1, "date": 0, "chat": {"id": 77, "type": "private"}}}
+        FakeTelegram.updates.append({"update_id": next(update_ids), "callback_query": cb})
+    threading.Thread(target=main.bot.infinity_polling, kwargs={"timeout": 1, "long_polling_timeout": 1}, daemon=True).start()
+    started = time.perf_counter()
+    while len(set(seen)) < n and time.perf_counter() - started < 60: time.sleep(0.05)
+    time.sleep(0.5); main.bot.stop_polling(); main.process_action = process
+    dupes = len(seen) - len(set(seen))
+    print(f"\npolling: {n} callbacks via getUpdates, {len(set(seen))} handled, {dupes} handled more than once")
+    return dupes == 0 and len(set(seen)) == n
+
+def throughput(main, users):
+    # Pushes ticket-creation updates for many users through the dispatcher and waits for them all.
+    ups = []
+    for i, uid in enumerate(range(90000, 90000 + users)):
+        cb = {"id": str(i), "from": {"id": uid, "is_bot": False, "first_name": "x"}, "chat_instance": "b", "data": "cat|other", "message": {"message_id": 1, "date": 0, "chat": {"id": uid, "type": "private"}}}
+        ups.append(types.Update.de_json({"update_id": next(update_ids), "callback_query": cb}))
+        ups.append(types.Update.de_json({"update_id": next(update_ids), "message": message(uid, "load test").json}))
+    col = main.get_ticket_col("other"); before = col.count_documents({}); started = time.perf_counter()
+    main.bot.process_new_updates(ups)
+    while col.count_documents({}) < before + users and time.perf_counter() - started < 300: time.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    print(f"\nthroughput: {len(ups)} updates from {users} users on {main.UPDATE_WORKERS} workers in {elapsed:.2f}s ({len(ups) / elapsed:.0f} updates/s)")
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--tickets", type=int, default=2000, help="seeded tickets per category")
+    ap.add_argument("--users", type=int, default=300)
+    ap.add_argument("--heavy-share", type=float, default=0.1, help="share of tickets owned by one heavy user")
+    ap.add_argument("--rounds", type=int, default=30)
+    ap.add_argument("--load-users", type=int, default=200, help="users in the dispatcher throughput run, 0 to skip")
+    ap.add_argument("--poll-updates", type=int, default=30, help="callbacks in the long-polling check, 0 to skip")
+    args = ap.parse_args()
+
+    main = load_bot(); count_round_trips(); count_telegram(main)
+    seed(main, args.tickets, args.users, args.heavy_share)
+    rec = Recorder(); rnd = random.Random(1)
+    for r in range(args.rounds): session(main, rec, rnd, 2000 + r)
+    rec.report()
+    print(f"\nrender cache: {main.render_cache.stats()}  outbox: {main.outbox.stats()}")
+    ok = polling(main, args.poll_updates) if args.poll_updates else True
+    if args.load_users: throughput(main, args.load_users)
+    if not ok: sys.exit("❌ long polling handled updates more or less than once")
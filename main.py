@@ -2,11 +2,32 @@ import os
 import telebot
 from telebot import types
 import time
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import pymongo
 import certifi
 import threading
+import queue
 import traceback
+import copy
+import atexit
+import gzip
+import asyncio
+import hmac
+import secrets
+import ssl
+from http import HTTPStatus
+from urllib.parse import urlparse
+from bson import json_util
+import sys
+import re
+import heapq
+import bisect
+from itertools import islice
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pymongo import monitoring
 
 try:
     from dotenv import load_dotenv
@@ -27,44 +48,795 @@ CATEGORIES = {
     "Other": {"slug": "other", "icon": "❓", "priority": "NORMAL"}
 }
 
+# Managed indexes on every tickets_<slug> collection. Only names starting with "sb_" are
+# owned by the bot; changing a key spec means picking a new name, the old one gets dropped.
+TICKET_INDEXES = {
+    "sb_user_status_created_id": [("user_id", 1), ("status", 1), ("created_at", -1), ("_id", -1)],
+    "sb_user_created": [("user_id", 1), ("created_at", -1)],
+    "sb_status_resolved_id": [("status", 1), ("resolved_at", 1), ("_id", 1)],
+    "sb_username": [("username", 1)],
+    # Admin /search. No language, so tickets in any language are matched word for word.
+    "sb_text": ([("text", "text"), ("history.text", "text"), ("username", "text")],
+                {"default_language": "none", "weights": {"username": 5, "text": 3, "history.text": 1}}),
+}
+SUMMARY_INDEXES = {
+    "sb_last_activity": [("last_activity", -1), ("_id", -1)],
+}
+
+# --- METRICS ---
+# Latency histograms for callback actions, Mongo commands (per action, via command monitoring)
+# and Bot API calls, plus error counters. Kept per minute for the last METRICS_WINDOW minutes
+# (/stats) and as running totals (Prometheus text on METRICS_PORT, if set).
+METRICS_WINDOW = 15
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+LATENCY_BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Metrics:
+    def __init__(self, window):
+        self.window = window; self.lock = threading.Lock(); self.local = threading.local()
+        self.minutes = deque()  # (minute, hists, counters)
+        self.total = ({}, {})
+
+    def observe(self, key, seconds):
+        i = bisect.bisect_left(LATENCY_BOUNDS, seconds)
+        with self.lock:
+            for hists in (self._minute()[1], self.total[0]):
+                h = hists.get(key) or hists.setdefault(key, [[0] * (len(LATENCY_BOUNDS) + 1), 0.0])
+                h[0][i] += 1; h[1] += seconds
+
+    def incr(self, key, n=1):
+        with self.lock:
+            for counters in (self._minute()[2], self.total[1]): counters[key] = counters.get(key, 0) + n
+
+    def windowed(self):
+        hists, counters = {}, {}
+        with self.lock:
+            self._minute()
+            for _, mh, mc in self.minutes:
+                for key, (counts, total) in mh.items():
+                    h = hists.setdefault(key, [[0] * len(counts), 0.0])
+                    h[0] = [a + b for a, b in zip(h[0], counts)]; h[1] += total
+                for key, n in mc.items(): counters[key] = counters.get(key, 0) + n
+        return hists, counters
+
+    def totals(self):
+        with self.lock: return copy.deepcopy(self.total)
+
+    @contextmanager
+    def action(self, name):
+        self.local.action = name; started = time.perf_counter()
+        try: yield
+        finally:
+            self.observe(("action", name), time.perf_counter() - started); self.local.action = None
+
+    def current_action(self):
+        return getattr(self.local, 'action', None) or "background"
+
+    def bind(self, fn):
+        # Wraps fn to run under the calling thread's action, for work handed to a thread pool.
+        name = self.current_action()
+        def run(*args, **kwargs):
+            self.local.action = name
+            try: return fn(*args, **kwargs)
+            finally: self.local.action = None
+        return run
+
+    def _minute(self):
+        m = int(time.time() // 60)
+        if not self.minutes or self.minutes[-1][0] != m:
+            self.minutes.append((m, {}, {}))
+            while self.minutes[0][0] <= m - self.window: self.minutes.popleft()
+        return self.minutes[-1]
+
+metrics = Metrics(METRICS_WINDOW)
+
+class MongoMetrics(monitoring.CommandListener):
+    def started(self, event): pass
+
+    def succeeded(self, event):
+        metrics.observe(("mongo", metrics.current_action(), event.command_name), event.duration_micros / 1e6)
+
+    def failed(self, event):
+        metrics.observe(("mongo", metrics.current_action(), event.command_name), event.duration_micros / 1e6)
+        metrics.incr(("mongo_errors", event.command_name))
+
+_make_request = telebot.apihelper._make_request
+
+def timed_request(token, method_name, *args, **kwargs):
+    # getUpdates is a long poll that waits out its timeout and times out routinely; timing it
+    # would swamp the p95 and the error counts of the calls that actually answer users.
+    if method_name == "getUpdates": return _make_request(token, method_name, *args, **kwargs)
+    started = time.perf_counter()
+    try: return _make_request(token, method_name, *args, **kwargs)
+    except Exception: metrics.incr(("telegram_errors", method_name)); raise
+    finally: metrics.observe(("tg", method_name), time.perf_counter() - started)
+
+telebot.apihelper._make_request = timed_request
+
+def percentile(counts, p):
+    n = sum(counts); seen = 0
+    for bound, c in zip(LATENCY_BOUNDS + (None,), counts):
+        seen += c
+        if seen >= p * n: return f"{bound * 1000:g}" if bound else "inf"
+    return "-"
+
+def stats_text():
+    hists, counters = metrics.windowed()
+    actions = sorted(((k[1], v) for k, v in hists.items() if k[0] == "action"), key=lambda x: -x[1][1])
+    lines = [f"📊 *Last {METRICS_WINDOW} min*", "```", f"{'action':<11}{'n':>6}{'p50':>6}{'p95':>6}{'db/op':>6}{'dbms':>6}"]
+    for name, (counts, _) in actions[:15]:
+        n = sum(counts); db_ops = [v for k, v in hists.items() if k[0] == "mongo" and k[1] == name]
+        db_n = sum(sum(c) for c, _ in db_ops); db_ms = sum(t for _, t in db_ops) * 1000
+        lines.append(f"{name[:11]:<11}{n:>6}{percentile(counts, 0.5):>6}{percentile(counts, 0.95):>6}{db_n / n:>6.1f}{db_ms / n:>6.1f}")
+    tg = [sum(c) for c in zip(*[v[0] for k, v in hists.items() if k[0] == "tg"])] or [0]
+    lines.append(f"\ntelegram {sum(tg)} calls, p95 {percentile(tg, 0.95)} ms")
+    lines += [f"{k[0]}:{k[1]} {n}" for k, n in sorted(counters.items())]
+    lines.append(f"outbox {outbox.stats()}")
+    lines.append(f"dispatch queue {dispatcher.depth()}, states {len(user_states)}, render cache {render_cache.stats()}")
+    return "\n".join(lines + ["```"])
+
+def prom_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+PROM_METRICS = {"action": ("supportbot_action_seconds", ("action",)),
+                "mongo": ("supportbot_mongo_command_seconds", ("action", "command")),
+                "tg": ("supportbot_telegram_request_seconds", ("method",))}
+
+def prometheus_text():
+    hists, counters = metrics.totals(); lines = []; typed = set()
+    for key, (counts, total) in sorted(hists.items()):
+        name, labels = PROM_METRICS[key[0]]
+        if name not in typed: lines.append(f"# TYPE {name} histogram"); typed.add(name)
+        lbl = ",".join(f'{l}="{prom_label(v)}"' for l, v in zip(labels, key[1:])); seen = 0
+        for bound, c in zip(LATENCY_BOUNDS + (None,), counts):
+            seen += c; lines.append(f'{name}_bucket{{{lbl},le="{bound if bound else "+Inf"}"}} {seen}')
+        lines.append(f"{name}_sum{{{lbl}}} {total}"); lines.append(f"{name}_count{{{lbl}}} {seen}")
+    for key, n in sorted(counters.items()):
+        lines.append(f'supportbot_{key[0]}_total{{name="{prom_label(key[1])}"}} {n}')
+    gauges = {"outbox_depth": outbox.depth(), "dispatch_depth": dispatcher.depth(), "user_states": len(user_states),
+              "render_cache_hits": render_cache.hits, "render_cache_misses": render_cache.misses}
+    lines += [f"supportbot_{k} {v}" for k, v in gauges.items()]
+    return "\n".join(lines) + "\n"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics": self.send_error(404); return
+        body = prometheus_text().encode()
+        self.send_response(200); self.send_header("Content-Type", "text/plain; version=0.0.4"); self.send_header("Content-Length", str(len(body))); self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args): pass
+
+def start_metrics_server():
+    server = ThreadingHTTPServer(("0.0.0.0", METRICS_PORT), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"📈 Metrics on :{METRICS_PORT}/metrics")
+
 # --- DATABASE ---
 db = None
 settings_col = None
+db_ready = threading.Event()
 
 def connect_db():
     global db, settings_col
     try:
-        client = pymongo.MongoClient(MONGO_URI, tlsCAFile=certifi.where(), serverSelectionTimeoutMS=10000)
+        client = pymongo.MongoClient(MONGO_URI, tlsCAFile=certifi.where(), serverSelectionTimeoutMS=10000, event_listeners=[MongoMetrics()])
         client.admin.command('ping')
         db = client["SupportBotDB"]
         settings_col = db["settings"]
         print("✅ MongoDB Connected!")
     except Exception as e:
-        print(f"❌ DB Error: {e}")
+        print(f"❌ DB Error: {e}"); return
+    # A failed index build leaves the bot slower, not unusable, so it does not hold up startup.
+    if not ensure_indexes(): print("⚠️ Some indexes could not be set up; run 'check-indexes' after fixing them")
+    db_ready.set()
 
-threading.Thread(target=connect_db, daemon=True).start()
+def ensure_indexes():
+    ok = True
+    for s in CATEGORIES.values():
+        for col, declared in [(get_ticket_col(s['slug']), TICKET_INDEXES), (get_summary_col(s['slug']), SUMMARY_INDEXES)]:
+            try: existing = col.index_information()
+            except Exception as e: print(f"❌ Index Error on {col.name}: {e}"); ok = False; continue
+            for name in existing:
+                if name.startswith("sb_") and name not in declared:
+                    try: col.drop_index(name); print(f"🗑 Dropped stale index {col.name}.{name}")
+                    except Exception as e: print(f"❌ Index Error dropping {col.name}.{name}: {e}"); ok = False
+            for name, spec in declared.items():
+                keys, opts = spec if isinstance(spec, tuple) else (spec, {})
+                if name in existing: continue
+                try: col.create_index(keys, name=name, **opts); print(f"📇 Created index {col.name}.{name}")
+                except Exception as e: print(f"❌ Index Error creating {col.name}.{name}: {e}"); ok = False
+    return ok
+
+# --- ARCHIVAL ---
+# Resolved tickets older than ARCHIVE_AFTER_DAYS are moved out in batches of ARCHIVE_BATCH, in
+# (resolved_at, _id) order: each batch is appended to the archive, the checkpoint in settings is
+# advanced, then the batch is deleted by _id. A crash can at worst archive one batch twice.
+# ARCHIVE_MODE: "file" (gzipped JSONL under ARCHIVE_DIR), "collection" (archive_<slug>) or
+# "ttl" (a TTL index deletes them, nothing is kept). Users left without tickets are dropped
+# from user_summary_<slug>. Only the instance holding the "archive" lease in settings runs it.
+ARCHIVE_MODE = os.getenv("ARCHIVE_MODE", "file")
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+ARCHIVE_AFTER_DAYS = 30
+ARCHIVE_BATCH = 200
+ARCHIVE_OPS_PER_SEC = int(os.getenv("ARCHIVE_OPS_PER_SEC", "500"))
+ARCHIVE_KEYS = [("resolved_at", 1), ("_id", 1)]
+ARCHIVE_LEASE = 600
+INSTANCE_ID = secrets.token_hex(6)
+
+if ARCHIVE_MODE == "ttl":
+    TICKET_INDEXES["sb_ttl_resolved"] = ([("resolved_at", 1)], {"expireAfterSeconds": ARCHIVE_AFTER_DAYS * 86400, "partialFilterExpression": {"status": "resolved"}})
+
+def write_archive(slug, batch):
+    if ARCHIVE_MODE == "collection":
+        try: db[f"archive_{slug}"].insert_many(batch, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            if any(err['code'] != 11000 for err in e.details['writeErrors']): raise
+        return
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    path = os.path.join(ARCHIVE_DIR, f"tickets_{slug}-{datetime.now():%Y%m}.jsonl.gz")
+    data = "".join(json_util.dumps(t) + "\n" for t in batch).encode()
+    with open(path, "ab") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="ab") as gz: gz.write(data)
+        raw.flush(); os.fsync(raw.fileno())
 
-def auto_delete_resolved():
+def take_lease(name, seconds):
+    # True if this instance holds (or now renews) the lease; it lapses if not renewed in time.
+    now = datetime.now()
+    try:
+        settings_col.find_one_and_update({"_id": f"lease_{name}", "$or": [{"until": {"$lt": now}}, {"owner": INSTANCE_ID}]},
+                                         {"$set": {"owner": INSTANCE_ID, "until": now + timedelta(seconds=seconds)}}, upsert=True)
+        return True
+    except pymongo.errors.DuplicateKeyError: return False
+
+def release_lease(name):
+    settings_col.update_one({"_id": f"lease_{name}", "owner": INSTANCE_ID}, {"$set": {"until": datetime.now()}})
+
+def prune_summaries(slug, user_ids=None):
+    # Drops summaries of users with no tickets left in the category, checking `user_ids` or,
+    # without it, every summary. Summaries touched since the check started are kept.
+    col = get_ticket_col(slug); summary = get_summary_col(slug); started = datetime.now(); removed = 0
+    ids = iter(user_ids) if user_ids is not None else (u['_id'] for u in summary.find({}, {"_id": 1}))
     while True:
-        try:
-            time.sleep(3600) # Check every hour
-            if db:
-                for s in CATEGORIES.values():
-                    col = get_ticket_col(s['slug'])
-                    if col:
-                        cutoff = datetime.now() - timedelta(days=30)
-                        col.delete_many({"status": "resolved", "resolved_at": {"$lt": cutoff}})
-        except: pass
+        chunk = list(islice(ids, 500))
+        if not chunk: break
+        left = set(col.distinct("user_id", {"user_id": {"$in": chunk}}))
+        gone = [u for u in chunk if u not in left]
+        if gone: removed += summary.delete_many({"_id": {"$in": gone}, "last_activity": {"$lt": started}}).deleted_count
+    if removed: invalidate_counts(("users", slug)); render_cache.invalidate(("s", slug))
+    return removed
+
+def archive_category(slug, cutoff):
+    col = get_ticket_col(slug); ckpt_id = f"archive_{slug}"
+    base = {"status": "resolved", "resolved_at": {"$lt": cutoff}}
+    ckpt = settings_col.find_one({"_id": ckpt_id}) or {}
+    anchor = ckpt.get('anchor'); users = set()
+    if anchor:
+        # Anything up to the checkpoint is already archived; finish deleting it.
+        done = {"$and": [base, {"$nor": [keyset_filter(ARCHIVE_KEYS, anchor)]}]}
+        users.update(col.distinct("user_id", done)); col.delete_many(done)
+    moved = 0
+    while take_lease("archive", ARCHIVE_LEASE):
+        query = {"$and": [base, keyset_filter(ARCHIVE_KEYS, anchor)]} if anchor else base
+        batch = list(col.find(query).sort(ARCHIVE_KEYS).limit(ARCHIVE_BATCH))
+        if not batch: break
+        started = time.time()
+        write_archive(slug, batch)
+        anchor = [batch[-1]['resolved_at'], batch[-1]['_id']]
+        settings_col.update_one({"_id": ckpt_id}, {"$set": {"anchor": anchor}, "$inc": {"moved": len(batch)}}, upsert=True)
+        col.delete_many({"_id": {"$in": [t['_id'] for t in batch]}})
+        moved += len(batch); users.update(t['user_id'] for t in batch)
+        time.sleep(max(0, len(batch) / ARCHIVE_OPS_PER_SEC - (time.time() - started)))
+    prune_summaries(slug, users)
+    return moved
 
-threading.Thread(target=auto_delete_resolved, daemon=True).start()
+def archive_resolved():
+    if not take_lease("archive", ARCHIVE_LEASE):
+        print("ℹ️ Another instance is archiving"); return False
+    try:
+        if ARCHIVE_MODE == "ttl":
+            # The TTL index deletes tickets behind our back, so every summary gets checked.
+            pruned = sum(prune_summaries(s['slug']) for s in CATEGORIES.values())
+            print(f"ℹ️ ARCHIVE_MODE=ttl, resolved tickets expire through the sb_ttl_resolved index; dropped {pruned} empty user summaries"); return True
+        cutoff = datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)
+        moved = {s['slug']: archive_category(s['slug'], cutoff) for s in CATEGORIES.values()}
+        if any(moved.values()): clear_counts(); render_cache.clear()
+        print(f"📦 Archived {sum(moved.values())} tickets ({', '.join(f'{k}: {v}' for k, v in moved.items())})")
+        return moved
+    finally: release_lease("archive")
+
+def auto_archive_resolved():
+    while True:
+        time.sleep(3600) # Check every hour
+        if not db_ready.is_set(): continue
+        try: archive_resolved()
+        except Exception: traceback.print_exc()
+
+threading.Thread(target=auto_archive_resolved, daemon=True).start()
 
 def get_ticket_col(slug):
     if db is None: return None
     return db[f"tickets_{slug}"]
 
+def get_summary_col(slug):
+    if db is None: return None
+    return db[f"user_summary_{slug}"]
+
+# --- USER SUMMARY ---
+# One document per user and category, kept up to date by the write paths so the admin
+# user list never has to group over tickets_<slug>.
+def touch_user_summary(slug, user_id, opened=0, name=None, username=None):
+    update = {"$max": {"last_activity": datetime.now()}, "$inc": {"open_count": opened}}
+    if name is not None or username is not None: update["$set"] = {"name": name, "username": username}
+    get_summary_col(slug).update_one({"_id": int(user_id)}, update, upsert=True)
+    render_cache.invalidate(("s", slug))
+
+def resolve_ticket(slug, tid, user_id):
+    res = get_ticket_col(slug).update_one({"_id": tid, "status": "open"}, {"$set": {"status": "resolved", "resolved_at": datetime.now()}})
+    if res.modified_count:
+        get_summary_col(slug).update_one({"_id": int(user_id)}, {"$inc": {"open_count": -1}})
+        invalidate_counts(("tix", slug, int(user_id), "open"), ("tix", slug, int(user_id), "resolved"))
+        render_cache.invalidate(("t", slug, tid), ("u", slug, int(user_id)), ("self", int(user_id)))
+
+def resolve_tickets(slug, user_id, tids, reply=None):
+    # Bulk resolve for one user's tickets: one read for the history positions, one bulk_write.
+    # `reply` (a history entry without index) is appended to every ticket that gets resolved.
+    col = get_ticket_col(slug); user_id = int(user_id); now = datetime.now()
+    query = {"_id": {"$in": list(tids)}, "user_id": user_id, "status": "open"}
+    if reply: col.update_many({**query, **LEGACY_TICKET}, HISTORY_FIELDS_BACKFILL)
+    docs = list(col.find(query, {"history_len": 1}))
+    if not docs: return 0, []
+    entry = media_entry(0, reply) if reply else None
+    ops = []
+    for d in docs:
+        update = {"$set": {"status": "resolved", "resolved_at": now}}
+        match = {"_id": d['_id'], "status": "open"}
+        if reply:
+            # Matching on history_len makes a ticket that got a reply in the meantime drop out
+            # instead of receiving a duplicate index.
+            match["history_len"] = d['history_len']
+            update["$set"]["last_role"] = reply['role']
+            update["$push"] = {"history": {**reply, 'index': d['history_len'] + 1}}; update["$inc"] = {"history_len": 1}
+            if entry: update["$push"]["media"] = {**entry, 'i': d['history_len'] + 1}
+        ops.append(pymongo.UpdateOne(match, update))
+    n = col.bulk_write(ops, ordered=False).modified_count
+    done = [d['_id'] for d in docs]
+    if n < len(docs):
+        # Some tickets changed under us; ours are the ones stamped with this resolved_at.
+        done = [t['_id'] for t in col.find({"_id": {"$in": done}, "status": "resolved", "resolved_at": now}, {"_id": 1})]
+    if n:
+        get_summary_col(slug).update_one({"_id": user_id}, {"$inc": {"open_count": -n}})
+        if reply: touch_user_summary(slug, user_id)
+        invalidate_counts(("tix", slug, user_id, "open"), ("tix", slug, user_id, "resolved"))
+        render_cache.invalidate(("u", slug, user_id), ("self", user_id), *[("t", slug, d['_id']) for d in docs])
+    return n, done
+
+def rebuild_user_summaries():
+    for s in CATEGORIES.values():
+        col = get_ticket_col(s['slug']); summary = get_summary_col(s['slug'])
+        col.aggregate([
+            {"$sort": {"user_id": 1, "created_at": -1}},
+            {"$group": {
+                "_id": "$user_id",
+                "last_activity": {"$max": {"$max": [{"$max": "$history.time"}, "$created_at"]}},
+                "open_count": {"$sum": {"$cond": [{"$eq": ["$status", "open"]}, 1, 0]}},
+                "name": {"$first": "$name"}, "username": {"$first": "$username"}}},
+            {"$merge": {"into": summary.name, "whenMatched": "replace", "whenNotMatched": "insert"}}
+        ])
+        print(f"✅ {summary.name}: {summary.count_documents({})} users")
+    return True
+
+# --- TICKET IDS ---
+# Ticket numbers come from the settings counter ID_BLOCK at a time; one $inc reserves a range
+# that is then handed out from memory. A restart only leaves a gap, never a duplicate.
+ID_BLOCK = int(os.getenv("ID_BLOCK", "100"))
+
+class IdAllocator:
+    def __init__(self, key, block):
+        self.key = key; self.block = block
+        self.next = self.end = 0; self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            if self.next >= self.end:
+                doc = settings_col.find_one_and_update({"_id": self.key}, {"$inc": {"count": self.block}}, upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+                self.end = doc['count'] + 1; self.next = self.end - self.block
+                print(f"🔢 Reserved {self.key} {self.next}-{self.end - 1}")
+            n = self.next; self.next += 1
+            return n
+
+ticket_ids = IdAllocator("ticket_counter", ID_BLOCK)
+
+# --- HISTORY ---
+# history_len/last_role are stored next to the history array so views and replies never
+# need the whole thread. `media` indexes every photo/video in the ticket as {i, t, f}
+# (history index, type, file_id; i=0 is the opening message) so media lookups never scan
+# history. Tickets written before these fields existed are filled in on first use.
+MEDIA_FROM_HISTORY = {"$concatArrays": [
+    {"$cond": [{"$ifNull": ["$photo", False]}, [{"i": 0, "t": "photo", "f": "$photo"}],
+               {"$cond": [{"$ifNull": ["$video", False]}, [{"i": 0, "t": "video", "f": "$video"}], []]}]},
+    {"$map": {"input": {"$filter": {"input": {"$ifNull": ["$history", []]}, "as": "h", "cond": {"$ifNull": ["$$h.photo", "$$h.video"]}}}, "as": "h",
+              "in": {"i": "$$h.index", "t": {"$cond": [{"$ifNull": ["$$h.photo", False]}, "photo", "video"]}, "f": {"$ifNull": ["$$h.photo", "$$h.video"]}}}}]}
+HISTORY_FIELDS_BACKFILL = [{"$set": {
+    "history_len": {"$ifNull": ["$history_len", {"$size": {"$ifNull": ["$history", []]}}]},
+    "last_role": {"$ifNull": ["$last_role", {"$ifNull": [{"$arrayElemAt": ["$history.role", -1]}, "user"]}]},
+    "media": {"$ifNull": ["$media", MEDIA_FROM_HISTORY]}}}]
+LEGACY_TICKET = {"$or": [{"history_len": {"$exists": False}}, {"media": {"$exists": False}}]}
+
+def media_entry(i, src):
+    if src.get('photo'): return {'i': i, 't': 'photo', 'f': src['photo']}
+    if src.get('video'): return {'i': i, 't': 'video', 'f': src['video']}
+    return None
+
+def next_history_index(col, tid):
+    inc = lambda: col.find_one_and_update({"_id": tid, "history_len": {"$exists": True}, "media": {"$exists": True}}, {"$inc": {"history_len": 1}},
+                                          projection={"history_len": 1}, return_document=pymongo.ReturnDocument.AFTER)
+    t = inc()
+    if t is None:
+        col.update_one({"_id": tid, **LEGACY_TICKET}, HISTORY_FIELDS_BACKFILL); t = inc()
+    return t['history_len'] if t else None
+
+def backfill_tickets():
+    for s in CATEGORIES.values():
+        col = get_ticket_col(s['slug'])
+        res = col.update_many(LEGACY_TICKET, HISTORY_FIELDS_BACKFILL)
+        print(f"✅ {col.name}: history_len/media set on {res.modified_count} tickets")
+    return True
+
+# --- QUERY PLAN CHECK ---
+# Every hot query shape, with placeholder values. Keep in sync with the renderers below.
+QUERY_SHAPES = {
+    "user_tickets": lambda slug: get_ticket_col(slug).find({"user_id": 0, "status": "open"}).sort([("created_at", -1), ("_id", -1)]).limit(10).explain(),
+    "self_tickets": lambda slug: get_ticket_col(slug).find({"user_id": 0, "status": "open"}).explain(),
+    "archive": lambda slug: get_ticket_col(slug).find({"status": "resolved", "resolved_at": {"$lt": datetime.now()}}).sort(ARCHIVE_KEYS).limit(ARCHIVE_BATCH).explain(),
+    "user_list": lambda slug: get_summary_col(slug).find({}).sort([("last_activity", -1), ("_id", -1)]).limit(10).explain(),
+    "search_prefix": lambda slug: get_ticket_col(slug).find(prefix_query("x")).limit(SEARCH_LIMIT).explain(),
+    "search_text": lambda slug: get_ticket_col(slug).find({"$text": {"$search": "x"}}).limit(SEARCH_LIMIT).explain(),
+}
+
+def find_stages(plan, stage):
+    if isinstance(plan, dict):
+        if plan.get("stage") == stage: return True
+        return any(find_stages(v, stage) for v in plan.values())
+    if isinstance(plan, list): return any(find_stages(v, stage) for v in plan)
+    return False
+
+def verify_indexes():
+    failed = []
+    for s in CATEGORIES.values():
+        for shape, explain in QUERY_SHAPES.items():
+            if find_stages(explain(s['slug']), "COLLSCAN"): failed.append(f"{s['slug']}:{shape}")
+    for f in failed: print(f"❌ COLLSCAN: {f}")
+    if not failed: print(f"✅ {len(QUERY_SHAPES)} query shapes use an index in all {len(CATEGORIES)} categories")
+    return not failed
+
+# --- STATE ---
+# Conversation state per user: menus, navigation history and pending replies. STATE_BACKEND=mongo
+# keeps it in the user_states collection so it survives restarts and is shared between instances.
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")
+STATE_MAX = int(os.getenv("STATE_MAX", "10000"))
+STATE_TTL = 3600
+STATE_SWEEP = 60
+STATE_FLUSH = 1
+STATE_REFRESH = 5
+
+class StateStore:
+    # Dict-like, capped at max_size entries (least recently used go first) and swept every
+    # STATE_SWEEP seconds for entries idle longer than ttl.
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size; self.ttl = ttl
+        self.data = OrderedDict()  # uid -> [state or None, last_used, loaded_at, saved digest]
+        self.lock = threading.RLock()
+        threading.Thread(target=self._sweep_loop, daemon=True).start()
+
+    def get(self, uid, default=None):
+        e = self._lookup(uid)
+        with self.lock:
+            if e[0] is None: return default
+            self._changed(uid, e[0]); return e[0]
+
+    def __getitem__(self, uid):
+        state = self.get(uid)
+        if state is None: raise KeyError(uid)
+        return state
+
+    def __setitem__(self, uid, state):
+        e = self._lookup(uid)
+        with self.lock: e[0] = state; self._changed(uid, state)
+
+    def setdefault(self, uid, default):
+        e = self._lookup(uid)
+        with self.lock:
+            if e[0] is None: e[0] = default
+            self._changed(uid, e[0]); return e[0]
+
+    def pop(self, uid, default=None):
+        e = self._lookup(uid)
+        with self.lock:
+            state, e[0] = e[0], None
+            if state is None: return default
+            self._changed(uid, None); return state
+
+    def touch(self, uid):
+        # Marks a state changed again after a handler that may have mutated it has finished.
+        with self.lock:
+            e = self.data.get(uid)
+            if e is not None and e[0] is not None: self._changed(uid, e[0])
+
+    def __len__(self):
+        return len(self.data)
+
+    def sweep(self):
+        cutoff = time.time() - self.ttl
+        with self.lock:
+            for uid in [u for u, e in self.data.items() if e[1] < cutoff]: del self.data[uid]
+
+    def _lookup(self, uid):
+        with self.lock:
+            e = self.data.get(uid)
+            if e is not None and not self._stale(uid, e):
+                e[1] = time.time(); self.data.move_to_end(uid); return e
+        state, digest = self._load(uid)
+        with self.lock:
+            e = self.data[uid] = [state, time.time(), time.time(), digest]
+            while len(self.data) > self.max_size: self.data.popitem(last=False)
+            return e
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(STATE_SWEEP)
+            try: self.sweep()
+            except Exception: traceback.print_exc()
+
+    def _load(self, uid): return None, None  # state, digest of the stored copy
+    def _stale(self, uid, entry): return False
+    def _changed(self, uid, state): pass
+
+class MongoStateStore(StateStore):
+    # Write-behind over the user_states collection: every state handed out is marked dirty and
+    # flushed in one bulk_write every STATE_FLUSH seconds; states whose contents did not change
+    # since they were loaded or last written are skipped. Idle documents expire through a TTL
+    # index, and clean local copies older than STATE_REFRESH are re-read so other instances'
+    # writes show up. States stay "in flight" until the write is acknowledged so a refresh
+    # cannot read back the older document meanwhile.
+    def __init__(self, max_size, ttl):
+        super().__init__(max_size, ttl)
+        self.dirty = {}; self.flushing = {}; self.indexed = False
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+        atexit.register(self.flush)
+
+    def col(self):
+        return None if db is None else db["user_states"]
+
+    def flush(self):
+        col = self.col()
+        if col is None: return
+        if not self.indexed:
+            col.create_index("updated_at", expireAfterSeconds=self.ttl, name="sb_ttl"); self.indexed = True
+        with self.lock: batch, self.dirty = self.dirty, {}; self.flushing.update(batch)
+        ops = []; written = {}; now = datetime.now(timezone.utc)
+        for uid, state in batch.items():
+            if state is None: ops.append(pymongo.DeleteOne({"_id": uid})); continue
+            try: doc = copy.deepcopy(state)
+            except RuntimeError:
+                with self.lock: self.dirty.setdefault(uid, state)  # mutated mid-copy, retry next round
+                continue
+            digest = self._digest(doc)
+            with self.lock: e = self.data.get(uid)
+            if e is not None and e[0] is state and e[3] == digest: continue
+            written[uid] = digest; ops.append(pymongo.ReplaceOne({"_id": uid}, {"state": doc, "updated_at": now}, upsert=True))
+        ok = True
+        try:
+            if ops: col.bulk_write(ops, ordered=False)
+        except Exception as e:
+            print(f"❌ State flush failed: {e}"); ok = False
+        with self.lock:
+            for uid, state in batch.items():
+                if self.flushing.get(uid) is state: del self.flushing[uid]
+                if not ok: self.dirty.setdefault(uid, state); continue
+                e = self.data.get(uid)
+                if uid in written and e is not None and e[0] is state: e[2] = time.time(); e[3] = written[uid]
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(STATE_FLUSH)
+            try: self.flush()
+            except Exception: traceback.print_exc()
+
+    def _load(self, uid):
+        with self.lock:
+            if uid in self.dirty: return self.dirty[uid], None
+            if uid in self.flushing: return self.flushing[uid], None
+        col = self.col()
+        doc = col.find_one({"_id": uid}) if col is not None else None
+        return (doc['state'], self._digest(doc['state'])) if doc else (None, None)
+
+    def _digest(self, state):
+        return None if state is None else repr(state)
+
+    def _stale(self, uid, entry):
+        return uid not in self.dirty and uid not in self.flushing and time.time() - entry[2] > STATE_REFRESH
+
+    def _changed(self, uid, state):
+        self.dirty[uid] = state
+
 # --- BOT SETUP ---
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="Markdown")
-user_states = {}
+bot = telebot.TeleBot(BOT_TOKEN, parse_mode="Markdown", threaded=False)
+user_states = (MongoStateStore if STATE_BACKEND == "mongo" else StateStore)(STATE_MAX, STATE_TTL)
+
+def user_state(uid):
+    return user_states.setdefault(uid, {})
+
+# --- OUTBOX ---
+# Notifications are queued and delivered by background workers. Chats are sharded onto
+# workers so each chat keeps its order, and every send takes a token from a per-chat and a
+# global bucket (Telegram allows ~1 msg/s per chat and ~30 msg/s overall). A send that has to
+# wait for its chat is parked on the worker's delay heap so other chats keep flowing; only
+# the global bucket blocks the worker.
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))
+OUTBOX_SIZE = 1000
+GLOBAL_RATE = 25
+CHAT_RATE = 1
+SEND_ATTEMPTS = 5
+DIGEST_MAX_CHARS = 3500
+DIGEST_MAX_BUTTONS = 100  # Telegram's limit per inline keyboard
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate; self.burst = burst; self.tokens = burst
+        self.stamp = time.monotonic(); self.lock = threading.Lock()
+
+    def reserve(self):
+        # Takes a token and returns how long the caller must wait before using it.
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate) - 1; self.stamp = now
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def hold(self, seconds):
+        # Pushes every later reservation back by `seconds` (used after a 429).
+        with self.lock: self.tokens -= seconds * self.rate
+
+class Outbox:
+    def __init__(self, workers, size):
+        self.queues = [queue.Queue(size) for _ in range(workers)]
+        self.bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        self.pending = {}; self.lock = threading.Lock()  # (chat_id, key) -> queued item
+        self.sent = self.failed = self.dropped = self.coalesced = 0
+        self.parked = []  # each worker's delay heap
+        for q in self.queues: threading.Thread(target=self._work, args=(q,), daemon=True).start()
+
+    def send(self, method, chat_id, *args, key=None, **kwargs):
+        # `key` identifies a notice; while one with the same key is still queued for the chat,
+        # a text notice is folded into it as a digest instead of being sent separately.
+        item = [method, chat_id, args, kwargs, None, 0]  # ..., pending key, attempts
+        if key is not None:
+            key = (chat_id, key)
+            with self.lock:
+                queued = self.pending.get(key)
+                if queued and self._merge(queued, item): self.coalesced += 1; return True
+                item[4] = key; self.pending[key] = item
+        try:
+            self.queues[hash(chat_id) % len(self.queues)].put_nowait(item)
+            return True
+        except queue.Full:
+            self._done(item); self.dropped += 1
+            print(f"❌ Outbox full, dropped {method} to {chat_id}"); return False
+
+    def depth(self):
+        return sum(q.qsize() for q in self.queues) + sum(len(h) for h in self.parked)
+
+    def stats(self):
+        return {"depth": self.depth(), "sent": self.sent, "failed": self.failed, "dropped": self.dropped, "coalesced": self.coalesced}
+
+    def _merge(self, queued, item):
+        if queued[0] != "send_message" or item[0] != "send_message": return False
+        text = f"{queued[2][0]}\n\n{item[2][0]}"
+        if len(text) > DIGEST_MAX_CHARS: return False
+        kb, seen = types.InlineKeyboardMarkup(), set()
+        for markup in (queued[3].get('reply_markup'), item[3].get('reply_markup')):
+            for row in (markup.keyboard if markup else []):
+                if all(b.callback_data in seen for b in row): continue
+                seen.update(b.callback_data for b in row); kb.row(*row)
+        if sum(len(row) for row in kb.keyboard) > DIGEST_MAX_BUTTONS: return False
+        queued[2] = (text,) + tuple(queued[2][1:]); queued[3] = {**queued[3], 'reply_markup': kb if seen else None}
+        return True
+
+    def _done(self, item):
+        if item[4] is None: return
+        with self.lock:
+            if self.pending.get(item[4]) is item: del self.pending[item[4]]
+
+    def _work(self, q):
+        chats = {}; delayed = []; seq = 0  # delayed: heap of (ready_at, seq, item)
+        self.parked.append(delayed)
+        while True:
+            now = time.monotonic()
+            if delayed and delayed[0][0] <= now: item = heapq.heappop(delayed)[2]
+            else:
+                try: item = q.get(timeout=delayed[0][0] - now if delayed else None)
+                except queue.Empty: continue
+                if item[1] not in chats: chats[item[1]] = TokenBucket(CHAT_RATE, 3)
+                wait = chats[item[1]].reserve()
+                if wait > 0:
+                    seq += 1; heapq.heappush(delayed, (now + wait, seq, item)); continue
+            time.sleep(self.bucket.reserve())
+            retry = self._deliver(item)
+            if retry is not None:
+                if item[1] in chats: chats[item[1]].hold(retry)
+                seq += 1; heapq.heappush(delayed, (time.monotonic() + retry, seq, item))
+            if len(chats) > 1000:
+                now = time.monotonic(); chats = {c: b for c, b in chats.items() if now - b.stamp < 60}
+
+    def _deliver(self, item):
+        # Returns the delay before the next attempt, or None once the item is finished.
+        self._done(item)
+        method, chat_id, args, kwargs = item[:4]; item[5] += 1
+        try:
+            getattr(bot, method)(chat_id, *args, **kwargs); self.sent += 1; return None
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code != 429:
+                print(f"❌ Outbox {method} to {chat_id}: {e.description}"); self.failed += 1; return None
+            delay = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+        except Exception as e:
+            print(f"⚠️ Outbox {method} to {chat_id} (attempt {item[5]}): {e}"); delay = 2 ** (item[5] - 1)
+        if item[5] >= SEND_ATTEMPTS: self.failed += 1; return None
+        return delay
+
+outbox = Outbox(OUTBOX_WORKERS, OUTBOX_SIZE)
+
+def notify(chat_id, message, text, reply_markup=None, key=None):
+    # Sends `text`, carrying over the photo/video of `message` if it has one.
+    if message.photo: outbox.send("send_photo", chat_id, message.photo[-1].file_id, caption=text, reply_markup=reply_markup, key=key)
+    elif message.video: outbox.send("send_video", chat_id, message.video.file_id, caption=text, reply_markup=reply_markup, key=key)
+    else: outbox.send("send_message", chat_id, text, reply_markup=reply_markup, key=key)
+
+# --- DISPATCH ---
+# Updates are fanned out to UPDATE_WORKERS threads by sender id: one user's updates run in
+# order on a single worker while different users are handled in parallel.
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+UPDATE_QUEUE_SIZE = 1000
+
+class UpdateDispatcher:
+    def __init__(self, workers, size):
+        self.queues = [queue.Queue(size) for _ in range(workers)]
+        for q in self.queues: threading.Thread(target=self._work, args=(q,), daemon=True).start()
+
+    @staticmethod
+    def sender(update):
+        src = update.message or update.callback_query or update.edited_message
+        user = getattr(src, 'from_user', None)
+        return user.id if user else None
+
+    def submit(self, update, block=True):
+        uid = self.sender(update)
+        try:
+            self.queues[(uid if uid is not None else update.update_id) % len(self.queues)].put(update, block=block)
+            return True
+        except queue.Full: return False
+
+    def dispatch(self, updates):
+        # Long polling asks for updates after bot.last_update_id, which telebot would only advance
+        # once the update is processed on a worker; advance it here so queued updates are not
+        # fetched (and handled) again.
+        for u in updates:
+            bot.last_update_id = max(bot.last_update_id, u.update_id); self.submit(u)
+
+    def depth(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def _work(self, q):
+        while True:
+            update = q.get()
+            try: telebot.TeleBot.process_new_updates(bot, [update])
+            except Exception: metrics.incr(("errors", "dispatch")); traceback.print_exc()
+            # Handlers keep mutating the state dict after fetching it; a flush taken in between
+            # wrote an older copy, so the final contents are queued for writing here.
+            uid = self.sender(update)
+            if uid is not None: user_states.touch(uid)
+
+dispatcher = UpdateDispatcher(UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+bot.process_new_updates = dispatcher.dispatch
 
 # --- HELPERS ---
 def is_admin(uid): 
@@ -75,9 +847,11 @@ def smart_edit(chat_id, message_id, text, reply_markup=None):
         bot.edit_message_text(text, chat_id, message_id, reply_markup=reply_markup, parse_mode="Markdown")
     except Exception as e:
         if "message is not modified" in str(e): return
+        metrics.incr(("errors", "smart_edit"))
         try:
             bot.send_message(chat_id, text, reply_markup=reply_markup, parse_mode="Markdown")
-        except: pass
+        except Exception as e:
+            metrics.incr(("errors", "smart_edit_send")); print(f"❌ smart_edit to {chat_id}: {e}")
 
 def get_pagination_row(prefix, current_page, total_pages, suffix=""):
     row = []
@@ -95,25 +869,161 @@ def get_pagination_row(prefix, current_page, total_pages, suffix=""):
     row.append(types.InlineKeyboardButton("➡️", callback_data=f"ignore" if current_page >= total_pages else f"{prefix}{next_p}{suffix}"))
     return row
 
+# --- PAGINATION ---
+# Counts are cached per list and dropped by the write paths; the TTL only bounds drift
+# from writes made by other instances.
+COUNT_TTL = 60
+COUNT_CACHE_SIZE = 10000
+count_cache = OrderedDict()
+count_lock = threading.Lock()
+
+def cached_count(key, compute):
+    with count_lock:
+        hit = count_cache.get(key)
+        if hit and time.time() - hit[1] < COUNT_TTL: return hit[0]
+    n = compute()
+    with count_lock:
+        count_cache[key] = (n, time.time()); count_cache.move_to_end(key)
+        if len(count_cache) > COUNT_CACHE_SIZE: count_cache.popitem(last=False)
+    return n
+
+def invalidate_counts(*keys):
+    with count_lock:
+        for k in keys: count_cache.pop(k, None)
+
+def clear_counts():
+    with count_lock: count_cache.clear()
+
+def keyset_filter(keys, anchor):
+    ors = []
+    for i, (field, direction) in enumerate(keys):
+        cond = {f: anchor[j] for j, (f, _) in enumerate(keys[:i])}
+        cond[field] = {"$lt" if direction < 0 else "$gt": anchor[i]}
+        ors.append(cond)
+    return {"$or": ors}
+
+def anchored(query, keys, page, anchors):
+    # anchors maps str(page) -> sort key of the last document before that page. Pages we have
+    # an anchor for cost one indexed range scan; jumps skip forward from the nearest anchor.
+    start = max([int(p) for p in anchors if int(p) <= page] or [1])
+    if start > 1: query = {"$and": [query, keyset_filter(keys, anchors[str(start)])]}
+    return query, start
+
+def keyset_page(col, query, keys, page, per_page, anchors, projection=None, count=None):
+    # With `count` known, a page closer to the end than to the nearest anchor is read from the
+    # end in reverse order, so jumping to the last pages from the page picker stays cheap.
+    base = query
+    query, start = anchored(query, keys, page, anchors)
+    end = min(page * per_page, count) if count is not None else None
+    if end is not None and count - end < (page - start) * per_page:
+        reverse = [(f, -d) for f, d in keys]
+        docs = list(col.find(base, projection).sort(reverse).skip(count - end).limit(max(0, end - (page - 1) * per_page)))[::-1]
+    else:
+        docs = list(col.find(query, projection).sort(keys).skip((page - start) * per_page).limit(per_page))
+    if len(docs) == per_page: anchors[str(page + 1)] = [docs[-1][f] for f, _ in keys]
+    return docs
+
+def keyset_merge(cols, query, keys, page, per_page, anchors, projection=None):
+    # Same as keyset_page over several collections: each one returns at most the rows the
+    # page could need, already sorted, and they are merged lazily. Keys must all be descending.
+    query, start = anchored(query, keys, page, anchors)
+    need = (page - start + 1) * per_page
+    cursors = [({**d, 'slug': slug} for d in col.find(query, projection).sort(keys).limit(need)) for slug, col in cols]
+    merged = heapq.merge(*cursors, key=lambda d: tuple(d[f] for f, _ in keys), reverse=True)
+    docs = list(islice(merged, (page - start) * per_page, need))
+    if len(docs) == per_page: anchors[str(page + 1)] = [docs[-1][f] for f, _ in keys]
+    return docs
+
+def list_anchors(uid, config, slot='list_config'):
+    prev = user_states.get(uid, {}).get(slot) or {}
+    same = all(prev.get(k) == config.get(k) for k in ('type', 'slug', 'target_uid', 'status', 'count'))
+    config['anchors'] = prev.get('anchors', {}) if same else {}
+    return config['anchors']
+
+# --- RENDER CACHE ---
+# Rendered (text, keyboard) pairs keyed by view and arguments. Each entry carries tags for the
+# data it was built from, and the write paths invalidate by tag:
+#   ("s", slug)           user list of a category
+#   ("u", slug, user_id)  one user's tickets in a category (admin view)
+#   ("self", user_id)     a user's own ticket list
+#   ("t", slug, tid)      one ticket
+# Builders return (text, kb, meta); meta holds the per-user state the view sets (page config,
+# history window) and is re-applied on every hit. The TTL bounds staleness from other instances.
+RENDER_CACHE_SIZE = 2000
+RENDER_CACHE_TTL = 60
+
+class RenderCache:
+    def __init__(self, size, ttl):
+        self.size = size; self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (result, tags, stamp)
+        self.by_tag = {}
+        self.gen = 0; self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, tags, build):
+        with self.lock:
+            e = self.entries.get(key)
+            if e and time.time() - e[2] < self.ttl:
+                self.hits += 1; self.entries.move_to_end(key); return e[0]
+            self.misses += 1; gen = self.gen
+        result = build()
+        with self.lock:
+            # Skip storing if anything was invalidated while building; it may be stale already.
+            if result is not None and gen == self.gen:
+                self._drop(key)
+                self.entries[key] = (result, tags, time.time())
+                for tag in tags: self.by_tag.setdefault(tag, set()).add(key)
+                while len(self.entries) > self.size: self._drop(next(iter(self.entries)))
+        return result
+
+    def invalidate(self, *tags):
+        with self.lock:
+            self.gen += 1
+            for tag in tags:
+                for key in self.by_tag.pop(tag, ()): self._drop(key)
+
+    def clear(self):
+        with self.lock: self.gen += 1; self.entries.clear(); self.by_tag.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+    def _drop(self, key):
+        e = self.entries.pop(key, None)
+        if not e: return
+        for tag in e[1]:
+            keys = self.by_tag.get(tag)
+            if keys:
+                keys.discard(key)
+                if not keys: del self.by_tag[tag]
+
+render_cache = RenderCache(RENDER_CACHE_SIZE, RENDER_CACHE_TTL)
+
+def cached_render(uid, key, tags, build):
+    res = render_cache.get(key, tags, build)
+    if res is None: return None
+    text, kb, meta = res
+    if uid is not None and meta: user_state(uid).update(copy.deepcopy(meta))
+    return text, kb
+
 # --- RENDERERS ---
 def render_user_list(chat_id, msg_id, uid, slug, page=1):
-    page = int(page); col = get_ticket_col(slug)
-    if col is None: return
-    count_res = list(col.aggregate([{"$group": {"_id": "$user_id"}}, {"$count": "total"}]))
-    count = count_res[0]["total"] if count_res else 0
+    if get_summary_col(slug) is None: return
+    text, kb = cached_render(uid, ("u_list", slug, int(page)), [("s", slug)], lambda: build_user_list(uid, slug, int(page)))
+    smart_edit(chat_id, msg_id, text, reply_markup=kb)
+
+def build_user_list(uid, slug, page):
+    col = get_summary_col(slug)
+    count = cached_count(("users", slug), lambda: col.count_documents({}))
     per_page = 10; total_pages = max(1, (count + per_page - 1) // per_page)
     page = max(1, min(page, total_pages))
-    if uid not in user_states: user_states[uid] = {}
-    user_states[uid]['list_config'] = {'type': 'u_list', 'slug': slug, 'total': total_pages, 'page': page}
-    pipeline = [
-        {"$group": {"_id": "$user_id", "last_ticket": {"$max": "$created_at"}, "name": {"$first": "$name"}, "username": {"$first": "$username"}}},
-        {"$sort": {"last_ticket": -1}}, {"$skip": (page - 1) * per_page}, {"$limit": per_page}
-    ]
-    current = list(col.aggregate(pipeline))
+    config = {'type': 'u_list', 'slug': slug, 'total': total_pages, 'page': page, 'count': count}
+    anchors = list_anchors(uid, config)
+    current = keyset_page(col, {}, [("last_activity", -1), ("_id", -1)], page, per_page, anchors, {"name": 1, "username": 1, "last_activity": 1}, count=count)
     kb = types.InlineKeyboardMarkup(row_width=2)
     if count == 0:
         kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="t_menu"))
-        smart_edit(chat_id, msg_id, f"✅ *No users in {slug.upper()}*", reply_markup=kb); return
+        return f"✅ *No users in {slug.upper()}*", kb, {'list_config': config}
     
     btns = []
     for u in current:
@@ -123,7 +1033,7 @@ def render_user_list(chat_id, msg_id, uid, slug, page=1):
     
     kb.row(*get_pagination_row(f"u_list|{slug}|", page, total_pages))
     kb.add(types.InlineKeyboardButton("🔙 Back", callback_data="t_menu"))
-    smart_edit(chat_id, msg_id, f"👥 *Users in {slug.upper()}*", reply_markup=kb)
+    return f"👥 *Users in {slug.upper()}*", kb, {'list_config': config}
 
 def render_page_list(chat_id, msg_id, uid):
     config = user_states.get(uid, {}).get('list_config')
@@ -149,118 +1059,185 @@ def render_page_list(chat_id, msg_id, uid):
     kb.add(types.InlineKeyboardButton("❌ CLOSE", callback_data=close_cb))
     smart_edit(chat_id, msg_id, "🔢 *Select Page:*", reply_markup=kb)
 
+# Multi-select on an admin's open-ticket list lives in user state as 'bulk' and is rendered
+# uncached, since the checkmarks are per admin.
+BULK_MAX = 500
+
+def selection(uid, slug, target_uid):
+    bulk = user_states.get(uid, {}).get('bulk')
+    return bulk if bulk and bulk['slug'] == slug and bulk['target_uid'] == target_uid else None
+
 def render_user_tickets(chat_id, msg_id, uid, slug, target_uid, page=1, status="open", notification=""):
-    page = int(page); target_uid = int(target_uid); col = get_ticket_col(slug)
-    query = {"user_id": target_uid, "status": status}
-    count = col.count_documents(query)
+    page = int(page); target_uid = int(target_uid)
+    bulk = selection(uid, slug, target_uid) if status == "open" else None
+    if bulk is not None:
+        title, kb, meta = build_user_tickets(uid, slug, target_uid, page, status, bulk['ids'])
+        user_state(uid).update(meta); bulk['page'] = meta['list_config']['page']
+    else:
+        title, kb = cached_render(uid, ("u_tix", slug, target_uid, page, status), [("u", slug, target_uid)], lambda: build_user_tickets(uid, slug, target_uid, page, status))
+    if notification: title = f"*{notification}*\n\n{title}"
+    smart_edit(chat_id, msg_id, title, reply_markup=kb)
+
+def build_user_tickets(uid, slug, target_uid, page, status, selected=None):
+    col = get_ticket_col(slug); query = {"user_id": target_uid, "status": status}
+    count = cached_count(("tix", slug, target_uid, status), lambda: col.count_documents(query))
     per_page = 10; total_pages = max(1, (count + per_page - 1) // per_page)
     page = max(1, min(page, total_pages))
-    if uid not in user_states: user_states[uid] = {}
-    user_states[uid]['list_config'] = {'type': 'u_tix', 'slug': slug, 'target_uid': target_uid, 'status': status, 'total': total_pages, 'page': page}
+    config = {'type': 'u_tix', 'slug': slug, 'target_uid': target_uid, 'status': status, 'total': total_pages, 'page': page, 'count': count}
+    anchors = list_anchors(uid, config)
     kb = types.InlineKeyboardMarkup(row_width=2)
     other_status = "resolved" if status == "open" else "open"
     kb.row(types.InlineKeyboardButton("✅ Show Resolved" if status == "open" else "🟢 Show Open", callback_data=f"u_tix|{slug}|{target_uid}|1|{other_status}"))
-    current = list(col.find(query).sort("created_at", -1).skip((page - 1) * per_page).limit(per_page))
+    current = keyset_page(col, query, [("created_at", -1), ("_id", -1)], page, per_page, anchors, {"created_at": 1}, count=count)
     
     btns = []
     for t in current:
-        btns.append(types.InlineKeyboardButton(f"🎫 #{t['_id']}", callback_data=f"t_view|{slug}|{t['_id']}|{target_uid}|{page}|{status}"))
+        if selected is not None:
+            btns.append(types.InlineKeyboardButton(f"{'☑️' if t['_id'] in selected else '⬜'} #{t['_id']}", callback_data=f"b_tog|{t['_id']}"))
+        else:
+            btns.append(types.InlineKeyboardButton(f"🎫 #{t['_id']}", callback_data=f"t_view|{slug}|{t['_id']}|{target_uid}|{page}|{status}"))
     kb.add(*btns)
     
     if count > 0: kb.row(*get_pagination_row(f"u_tix|{slug}|{target_uid}|", page, total_pages, suffix=f"|{status}"))
-    kb.add(types.InlineKeyboardButton("🔙 BACK TO USER LIST", callback_data=f"nav_back"))
     title = f"🛠 *Tickets for User {target_uid}* ({status.upper()})"
-    if notification: title = f"*{notification}*\n\n{title}"
-    smart_edit(chat_id, msg_id, title, reply_markup=kb)
+    if selected is not None:
+        kb.row(types.InlineKeyboardButton(f"✅ Resolve ({len(selected)})", callback_data="b_res" if selected else "ignore"),
+               types.InlineKeyboardButton("📩 Reply & Resolve", callback_data="b_rep" if selected else "ignore"))
+        kb.row(types.InlineKeyboardButton("☑️ Select All Open", callback_data=f"b_all|{slug}|{target_uid}"),
+               types.InlineKeyboardButton("❌ Cancel", callback_data="b_off"))
+        title += f"\nSelected: {len(selected)}"
+    elif status == "open" and count > 0:
+        kb.row(types.InlineKeyboardButton("☑️ Select", callback_data=f"b_sel|{slug}|{target_uid}"),
+               types.InlineKeyboardButton("☑️ Select All Open", callback_data=f"b_all|{slug}|{target_uid}"))
+    kb.add(types.InlineKeyboardButton("🔙 BACK TO USER LIST", callback_data=f"nav_back"))
+    return title, kb, {'list_config': config}
 
 def render_self_tickets(chat_id, msg_id, uid, page=1, status="open"):
-    page = int(page); uid = int(uid); all_tix = []
-    for s in CATEGORIES.values():
-        col = get_ticket_col(s['slug'])
-        if col is not None:
-            tix = list(col.find({"user_id": uid, "status": status}))
-            for t in tix: t['slug'] = s['slug']; all_tix.append(t)
-    all_tix.sort(key=lambda x: x['created_at'], reverse=True)
-    count = len(all_tix); per_page = 10; total_pages = max(1, (count + per_page - 1) // per_page)
+    page = int(page); uid = int(uid)
+    text, kb = cached_render(uid, ("self_tix", uid, page, status), [("self", uid)], lambda: build_self_tickets(uid, page, status))
+    smart_edit(chat_id, msg_id, text, reply_markup=kb)
+
+def build_self_tickets(uid, page, status):
+    query = {"user_id": uid, "status": status}
+    cols = [(s['slug'], get_ticket_col(s['slug'])) for s in CATEGORIES.values()]
+    cols = [(slug, col) for slug, col in cols if col is not None]
+    count = sum(cached_count(("tix", slug, uid, status), lambda: col.count_documents(query)) for slug, col in cols)
+    per_page = 10; total_pages = max(1, (count + per_page - 1) // per_page)
     page = max(1, min(page, total_pages))
+    config = {'type': 'self_tix', 'status': status, 'count': count}
+    anchors = list_anchors(uid, config, slot='self_list')
+    current = keyset_merge(cols, query, [("created_at", -1), ("_id", -1)], page, per_page, anchors, {"created_at": 1})
     kb = types.InlineKeyboardMarkup(row_width=1)
     kb.add(types.InlineKeyboardButton("✅ Show Resolved" if status == "open" else "🟢 Show Open", callback_data=f"self_tix|{page}|{'resolved' if status == 'open' else 'open'}"))
-    current = all_tix[(page-1)*per_page : page*per_page]
     for t in current: kb.add(types.InlineKeyboardButton(f"🎫 #{t['_id']}", callback_data=f"self_view|{t['slug']}|{t['_id']}"))
     kb.row(types.InlineKeyboardButton(f"{page}/{total_pages}", callback_data="ignore"),
            types.InlineKeyboardButton("➡️", callback_data=f"ignore" if page >= total_pages else f"self_tix|{page+1}|{status}"))
     kb.add(types.InlineKeyboardButton("❌ CLOSE", callback_data="close_menu"))
-    smart_edit(chat_id, msg_id, f"📂 *Your {status.upper()} Tickets:*", reply_markup=kb)
+    return f"📂 *Your {status.upper()} Tickets:*", kb, {'self_list': config}
 
-def render_ticket_view(chat_id, msg_id, slug, tid, target_uid, page, status):
-    col = get_ticket_col(slug); t = col.find_one({"_id": tid})
-    if not t: return
-    history = t.get('history', []); media_btns = []
-    chat_text = f"🎫 *Ticket #{tid}*\nCategory: `{slug.upper()}`\nStatus: `{t['status'].upper()}`\n\n"
-    
-    # Initial Message (Index 0)
-    tag = ""
-    if 'photo' in t: tag = "🖼️ [Photo #0] "; media_btns.append(types.InlineKeyboardButton("[0] 🖼️", callback_data=f"v_med|{slug}|{tid}|0"))
-    elif 'video' in t: tag = "🎥 [Video #0] "; media_btns.append(types.InlineKeyboardButton("[0] 🎥", callback_data=f"v_med|{slug}|{tid}|0"))
-    chat_text += f"👤 *You:* {tag}{t['text']}\n"
-    
+# Threads are rendered HISTORY_WINDOW entries at a time; entry indexes are 1-based and
+# sequential, so a window is addressed by the index of its newest entry (None = latest).
+HISTORY_WINDOW = 8
+ENTRY_MAX_CHARS = 400
+VIEW_FIELDS = {f: 1 for f in ("text", "status", "photo", "video", "history_len", "last_role", "media")}
+
+def load_ticket_window(slug, tid, last=None):
+    # The window is picked by entry index, not array position: replies on one ticket are pushed
+    # from different workers and can land in history out of index order.
+    newest = last or {"$ifNull": ["$history_len", {"$size": {"$ifNull": ["$history", []]}}]}
+    window = {"$filter": {"input": {"$ifNull": ["$history", []]}, "as": "h", "cond": {"$and": [
+        {"$gt": ["$$h.index", {"$subtract": [newest, HISTORY_WINDOW]}]}, {"$lte": ["$$h.index", newest]}]}}}
+    t = next(get_ticket_col(slug).aggregate([{"$match": {"_id": tid}}, {"$project": {"history": window, **VIEW_FIELDS}}]), None)
+    if t: t['history'].sort(key=lambda h: h['index'])
+    return t
+
+def clip(text):
+    # Entries are cut and then escaped, so a cut can never leave an unbalanced Markdown entity.
+    text = text if len(text) <= ENTRY_MAX_CHARS else text[:ENTRY_MAX_CHARS] + "…"
+    return re.sub(r"([_*`\[])", r"\\\1", text)
+
+def history_lines(slug, tid, t, parts, last=None):
+    history = t.get('history', [])
+    total = max(t.get('history_len', 0), history[-1]['index'] if history else 0)
+    end = min(last or total, total); first = max(1, end - HISTORY_WINDOW + 1)
+    if first <= 1:
+        tag = ""
+        if 'photo' in t: tag = "🖼️ [Photo #0] "
+        elif 'video' in t: tag = "🎥 [Video #0] "
+        parts.append(f"👤 *You:* {tag}{clip(t['text'])}\n")
+    else:
+        parts.append(f"⏳ _{first - 1} earlier messages_\n")
     for h in history:
         sender = "👤 *You*" if h['role'] == 'user' else "👨‍💻 *Admin*"
         tag = ""
-        if 'photo' in h: 
-            tag = f"🖼️ [Photo #{h['index']}] "
-            media_btns.append(types.InlineKeyboardButton(f"[{h['index']}] 🖼️", callback_data=f"v_med|{slug}|{tid}|{h['index']}"))
-        elif 'video' in h:
-            tag = f"🎥 [Video #{h['index']}] "
-            media_btns.append(types.InlineKeyboardButton(f"[{h['index']}] 🎥", callback_data=f"v_med|{slug}|{tid}|{h['index']}"))
-        chat_text += f"{sender}: {tag}{h['text']}\n"
+        if 'photo' in h: tag = f"🖼️ [Photo #{h['index']}] "
+        elif 'video' in h: tag = f"🎥 [Video #{h['index']}] "
+        parts.append(f"{sender}: {tag}{clip(h['text'])}\n")
+    # Buttons for the media shown in this window, taken from the media index.
+    media = t.get('media')
+    if media is None: media = [m for m in [media_entry(0, t)] + [media_entry(h['index'], h) for h in history] if m]
+    media_btns = [types.InlineKeyboardButton(f"[{m['i']}] {'🖼️' if m['t'] == 'photo' else '🎥'}", callback_data=f"v_med|{slug}|{tid}|{m['i']}")
+                  for m in media if (m['i'] == 0 and first <= 1) or first <= m['i'] <= end]
+    nav = []
+    if first > 1: nav.append(types.InlineKeyboardButton("⏪ Older", callback_data="h_win|-1"))
+    if end < total: nav.append(types.InlineKeyboardButton("Newer ⏩", callback_data="h_win|1"))
+    return media_btns, nav, total
+
+def render_ticket_view(chat_id, msg_id, slug, tid, target_uid, page, status, uid=None, last=None):
+    res = cached_render(uid, ("t_view", slug, tid, str(target_uid), str(page), status, last), [("t", slug, tid)], lambda: build_ticket_view(slug, tid, target_uid, page, status, last))
+    if res: smart_edit(chat_id, msg_id, res[0], reply_markup=res[1])
+
+def build_ticket_view(slug, tid, target_uid, page, status, last):
+    t = load_ticket_window(slug, tid, last)
+    if not t: return None
+    parts = [f"🎫 *Ticket #{tid}*\nCategory: `{slug.upper()}`\nStatus: `{t['status'].upper()}`\n\n"]
+    media_btns, nav, total = history_lines(slug, tid, t, parts, last)
 
     kb = types.InlineKeyboardMarkup(row_width=4)
     if media_btns:
         kb.row(*media_btns)
-        if len(media_btns) > 1:
+        if len(t.get('media') or media_btns) > 1:
             kb.add(types.InlineKeyboardButton("🖼️ VIEW ALL MEDIA", callback_data=f"v_all_med|{slug}|{tid}"))
+    if nav: kb.row(*nav)
     if t['status'] == 'open':
         kb.row(types.InlineKeyboardButton("📩 Reply", callback_data=f"t_rep|{slug}|{tid}|{target_uid}|{page}|{status}"),
                types.InlineKeyboardButton("✅ Resolve", callback_data=f"t_res|{slug}|{tid}|{target_uid}|{page}|{status}"))
     kb.add(types.InlineKeyboardButton("🔙 Back to Tickets", callback_data=f"nav_back"))
-    smart_edit(chat_id, msg_id, chat_text, reply_markup=kb)
+    return "".join(parts), kb, {'hist_win': {'tid': tid, 'last': last, 'len': total}}
 
-def render_self_view(chat_id, msg_id, uid, slug, tid):
-    col = get_ticket_col(slug); t = col.find_one({"_id": tid})
-    if not t: return
-    history = t.get('history', []); media_btns = []; last_role = 'user'
-    chat_text = f"🎫 *Ticket #{tid}* ({t['status'].upper()})\n\n"
-    
-    tag = ""
-    if 'photo' in t: tag = "🖼️ [Photo #0] "; media_btns.append(types.InlineKeyboardButton("[0] 🖼️", callback_data=f"v_med|{slug}|{tid}|0"))
-    elif 'video' in t: tag = "🎥 [Video #0] "; media_btns.append(types.InlineKeyboardButton("[0] 🎥", callback_data=f"v_med|{slug}|{tid}|0"))
-    chat_text += f"👤 *You:* {tag}{t['text']}\n"
-    
-    for h in history:
-        sender = "👤 *You*" if h['role'] == 'user' else "👨‍💻 *Admin*"
-        tag = ""; last_role = h['role']
-        if 'photo' in h: 
-            tag = f"🖼️ [Photo #{h['index']}] "
-            media_btns.append(types.InlineKeyboardButton(f"[{h['index']}] 🖼️", callback_data=f"v_med|{slug}|{tid}|{h['index']}"))
-        elif 'video' in h:
-            tag = f"🎥 [Video #{h['index']}] "
-            media_btns.append(types.InlineKeyboardButton(f"[{h['index']}] 🎥", callback_data=f"v_med|{slug}|{tid}|{h['index']}"))
-        chat_text += f"{sender}: {tag}{h['text']}\n"
+def render_self_view(chat_id, msg_id, uid, slug, tid, last=None):
+    res = cached_render(uid, ("self_view", slug, tid, last), [("t", slug, tid)], lambda: build_self_view(slug, tid, last))
+    if res: smart_edit(chat_id, msg_id, res[0], reply_markup=res[1])
+
+def build_self_view(slug, tid, last):
+    t = load_ticket_window(slug, tid, last)
+    if not t: return None
+    parts = [f"🎫 *Ticket #{tid}* ({t['status'].upper()})\n\n"]
+    media_btns, nav, total = history_lines(slug, tid, t, parts, last)
+    history = t.get('history', [])
+    last_role = t.get('last_role') or (history[-1]['role'] if history and not last else 'user')
 
     kb = types.InlineKeyboardMarkup(row_width=4)
     if media_btns:
         kb.row(*media_btns)
-        if len(media_btns) > 1:
+        if len(t.get('media') or media_btns) > 1:
             kb.add(types.InlineKeyboardButton("🖼️ VIEW ALL MEDIA", callback_data=f"v_all_med|{slug}|{tid}"))
+    if nav: kb.row(*nav)
     if t['status'] == 'open':
         if last_role == 'admin':
             kb.add(types.InlineKeyboardButton("📩 Reply to Admin", callback_data=f"u_rep|{slug}|{tid}"))
         kb.add(types.InlineKeyboardButton("✅ Resolve My Ticket", callback_data=f"self_res|{slug}|{tid}"))
     kb.add(types.InlineKeyboardButton("🔙 Back", callback_data=f"self_tix|1|{t['status']}"))
-    smart_edit(chat_id, msg_id, chat_text, reply_markup=kb)
+    return "".join(parts), kb, {'hist_win': {'tid': tid, 'last': last, 'len': total}}
 
 def render_main_menu(chat_id, msg_id, uid):
+    text, kb = cached_render(uid, ("menu", is_admin(uid)), [], lambda: build_main_menu(uid))
+    if msg_id:
+        smart_edit(chat_id, msg_id, text, reply_markup=kb)
+    else:
+        bot.send_message(chat_id, text, reply_markup=kb)
+
+def build_main_menu(uid):
     kb = types.InlineKeyboardMarkup()
     if is_admin(uid):
         kb.add(types.InlineKeyboardButton("📂 View Tickets", callback_data="t_menu"))
@@ -269,24 +1246,79 @@ def render_main_menu(chat_id, msg_id, uid):
             kb.add(types.InlineKeyboardButton(f"{v['icon']} {k}", callback_data=f"cat|{v['slug']}"))
         kb.add(types.InlineKeyboardButton("🎫 Check My Tickets", callback_data="self_tix|1|open"))
     
-    text = "👋 *Support Bot Active*"
-    if msg_id:
-        smart_edit(chat_id, msg_id, text, reply_markup=kb)
-    else:
-        bot.send_message(chat_id, text, reply_markup=kb)
+    return "👋 *Support Bot Active*", kb, {}
+
+# --- SEARCH ---
+# /search looks in every category at once on the search pool. A single-word query is also
+# matched as a ticket id or username prefix (anchored, so it stays on the _id/username
+# indexes) and those hits rank above text matches. Results are cached per query for
+# SEARCH_CACHE_TTL seconds and paged from the cache.
+SEARCH_LIMIT = 50
+SEARCH_PAGE = 8
+SEARCH_PREFIX_SCORE = 1000
+SEARCH_CACHE_SIZE = 200
+SEARCH_CACHE_TTL = 60
+SEARCH_FIELDS = {"user_id": 1, "username": 1, "status": 1, "created_at": 1}
+
+search_pool = ThreadPoolExecutor(len(CATEGORIES))
+search_cache = RenderCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+
+def prefix_query(term):
+    prefix = {"$regex": f"^{re.escape(term)}"}
+    return {"$or": [{"_id": prefix}, {"username": prefix}]}
+
+def search_category(slug, q):
+    col = get_ticket_col(slug); hits = {}
+    term = q.lstrip("#@")
+    if term and " " not in term:
+        for t in col.find(prefix_query(term), SEARCH_FIELDS).limit(SEARCH_LIMIT): hits[t['_id']] = {**t, 'score': SEARCH_PREFIX_SCORE}
+    score = {"$meta": "textScore"}
+    for t in col.find({"$text": {"$search": q}}, {**SEARCH_FIELDS, "score": score}).sort([("score", score)]).limit(SEARCH_LIMIT):
+        hits.setdefault(t['_id'], t)
+    return [{**t, 'slug': slug} for t in hits.values()]
+
+def search_tickets(q):
+    parts = search_pool.map(metrics.bind(lambda s: search_category(s['slug'], q)), CATEGORIES.values())
+    return sorted((t for part in parts for t in part), key=lambda t: (t['score'], t['created_at']), reverse=True)
+
+def render_search(chat_id, msg_id, uid, page=1):
+    q = user_states.get(uid, {}).get('search')
+    if not q: return
+    results = search_cache.get(("search", q), [], lambda: search_tickets(q))
+    total_pages = max(1, (len(results) + SEARCH_PAGE - 1) // SEARCH_PAGE)
+    page = max(1, min(int(page), total_pages))
+    icons = {v['slug']: v['icon'] for v in CATEGORIES.values()}
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    for t in results[(page - 1) * SEARCH_PAGE:page * SEARCH_PAGE]:
+        who = t.get('username') or t['user_id']
+        kb.add(types.InlineKeyboardButton(f"{icons[t['slug']]} #{t['_id']} · {who} · {t['status']}", callback_data=f"t_view|{t['slug']}|{t['_id']}|{t['user_id']}|1|{t['status']}"))
+    if total_pages > 1:
+        kb.row(types.InlineKeyboardButton("⬅️", callback_data=f"srch|{page - 1}" if page > 1 else "ignore"),
+               types.InlineKeyboardButton(f"{page}/{total_pages}", callback_data="ignore"),
+               types.InlineKeyboardButton("➡️", callback_data=f"srch|{page + 1}" if page < total_pages else "ignore"))
+    kb.add(types.InlineKeyboardButton("❌ CLOSE", callback_data="close_menu"))
+    text = f"🔎 *{len(results)} results for* `{q}`" if results else f"🔎 *No tickets match* `{q}`"
+    if msg_id: smart_edit(chat_id, msg_id, text, reply_markup=kb)
+    else: bot.send_message(chat_id, text, reply_markup=kb)
 
 # --- ROUTER ---
+def history_window(uid, tid, is_back):
+    # Older/newer flips and back navigation keep the window; opening a ticket starts at the latest.
+    win = user_states.get(uid, {}).get('hist_win')
+    return win['last'] if is_back and win and win['tid'] == tid else None
+
 def process_action(action, uid, chat_id, msg_id, call_id, is_back=False):
-    if uid not in user_states: user_states[uid] = {}
-    navigable = any(action.startswith(x) for x in ["u_list|", "u_tix|", "t_view|", "self_tix", "self_view"]) or action == "t_menu"
+    ustate = user_state(uid)
+    navigable = any(action.startswith(x) for x in ["u_list|", "u_tix|", "t_view|", "self_tix", "self_view", "srch|"]) or action == "t_menu"
+    if navigable and not action.startswith("u_tix|"): ustate.pop('bulk', None)
     if navigable and not is_back:
-        curr = user_states[uid].get('current_view')
+        curr = ustate.get('current_view')
         if curr and curr != action:
-            if 'hist' not in user_states[uid]: user_states[uid]['hist'] = []
-            if not user_states[uid]['hist'] or user_states[uid]['hist'][-1] != curr:
-                user_states[uid]['hist'].append(curr)
-                if len(user_states[uid]['hist']) > 20: user_states[uid]['hist'].pop(0)
-        user_states[uid]['current_view'] = action
+            if 'hist' not in ustate: ustate['hist'] = []
+            if not ustate['hist'] or ustate['hist'][-1] != curr:
+                ustate['hist'].append(curr)
+                if len(ustate['hist']) > 20: ustate['hist'].pop(0)
+        ustate['current_view'] = action
     
     if action == "t_menu":
         if not is_admin(uid): return
@@ -309,25 +1341,32 @@ def process_action(action, uid, chat_id, msg_id, call_id, is_back=False):
     elif action.startswith("self_tix|"):
         _, p, st = action.split("|"); render_self_tickets(chat_id, msg_id, uid, p, st)
     elif action.startswith("self_view|"):
-        render_self_view(chat_id, msg_id, uid, action.split("|")[1], action.split("|")[2])
+        _, s, tid = action.split("|")
+        render_self_view(chat_id, msg_id, uid, s, tid, last=history_window(uid, tid, is_back))
     elif action == "nav_back":
         hist = user_states.get(uid, {}).get('hist', [])
         if hist: process_action(hist.pop(), uid, chat_id, msg_id, call_id, is_back=True)
         else: process_action("t_menu", uid, chat_id, msg_id, call_id, is_back=True)
+    elif action.startswith("srch|"):
+        if not is_admin(uid): return
+        render_search(chat_id, msg_id, uid, action.split("|")[1])
     elif action.startswith("t_view|"):
         _, s, tid, t_uid, p, st = action.split("|")
-        render_ticket_view(chat_id, msg_id, s, tid, t_uid, p, st)
+        render_ticket_view(chat_id, msg_id, s, tid, t_uid, p, st, uid=uid, last=history_window(uid, tid, is_back))
+    elif action.startswith("h_win|"):
+        win = ustate.get('hist_win'); curr = ustate.get('current_view')
+        if not win or not curr: return
+        newest = win['last'] or win['len']
+        if int(action.split("|")[1]) < 0: win['last'] = max(newest - HISTORY_WINDOW, min(HISTORY_WINDOW, win['len']))
+        else: win['last'] = None if newest + HISTORY_WINDOW >= win['len'] else newest + HISTORY_WINDOW
+        process_action(curr, uid, chat_id, msg_id, call_id, is_back=True)
     elif action.startswith("v_med|"):
-        _, s, tid, idx = action.split("|"); col = get_ticket_col(s); t = col.find_one({"_id": tid})
+        _, s, tid, idx = action.split("|"); col = get_ticket_col(s); i = int(idx)
+        if i == 0: t = col.find_one({"_id": tid}, {"media": {"$elemMatch": {"i": 0}}, "text": 1, "photo": 1, "video": 1}); src = t
+        else: t = col.find_one({"_id": tid}, {"media": {"$elemMatch": {"i": i}}, "history": {"$elemMatch": {"index": i}}}); src = t and (t.get('history') or [{}])[0]
         if not t: return
-        file_id, m_type, m_text = None, None, ""
-        if idx == "0":
-            file_id = t.get('photo') or t.get('video'); m_type = 'photo' if 'photo' in t else 'video'
-            m_text = t.get('text', '')
-        else:
-            for h in t.get('history', []):
-                if h.get('index') == int(idx):
-                    file_id = h.get('photo') or h.get('video'); m_type = 'photo' if 'photo' in h else 'video'; m_text = h.get('text', ''); break
+        m = (t.get('media') or [None])[0] or media_entry(i, src)
+        file_id, m_type, m_text = (m['f'], m['t'], src.get('text', '')) if m else (None, None, "")
         if file_id:
             try:
                 caption = f"📩 Message: \"{m_text}\"" if m_text and m_text != "[Media]" else f"Media #{idx}"
@@ -335,103 +1374,253 @@ def process_action(action, uid, chat_id, msg_id, call_id, is_back=False):
                 else: bot.send_video(chat_id, file_id, caption=caption)
             except: bot.answer_callback_query(call_id, "❌ Error sending file.")
     elif action.startswith("v_all_med|"):
-        _, s, tid = action.split("|"); col = get_ticket_col(s); t = col.find_one({"_id": tid})
+        _, s, tid = action.split("|"); col = get_ticket_col(s); t = col.find_one({"_id": tid}, {"media": 1})
+        if t and 'media' not in t:
+            col.update_one({"_id": tid, **LEGACY_TICKET}, HISTORY_FIELDS_BACKFILL); t = col.find_one({"_id": tid}, {"media": 1})
         if not t: return
         media_list = []
-        if 'photo' in t: media_list.append(types.InputMediaPhoto(t['photo'], caption=f"🎫 Ticket #{tid} - #0"))
-        elif 'video' in t: media_list.append(types.InputMediaVideo(t['video'], caption=f"🎫 Ticket #{tid} - #0"))
-        for h in t.get('history', []):
-            if 'photo' in h: media_list.append(types.InputMediaPhoto(h['photo'], caption=f"Message #{h['index']}"))
-            elif 'video' in h: media_list.append(types.InputMediaVideo(h['video'], caption=f"Message #{h['index']}"))
+        for m in t.get('media') or []:
+            caption = f"🎫 Ticket #{tid} - #0" if m['i'] == 0 else f"Message #{m['i']}"
+            media_list.append((types.InputMediaPhoto if m['t'] == 'photo' else types.InputMediaVideo)(m['f'], caption=caption))
         if media_list:
             for i in range(0, len(media_list), 10):
                 try: bot.send_media_group(chat_id, media_list[i:i+10])
                 except: bot.answer_callback_query(call_id, "❌ Error sending album.")
         else: bot.answer_callback_query(call_id, "❌ No media found.")
     elif action.startswith("t_res|"):
-        _, s, tid, t_uid, p, st = action.split("|"); col = get_ticket_col(s)
-        col.update_one({"_id": tid}, {"$set": {"status": "resolved", "resolved_at": datetime.now()}})
+        _, s, tid, t_uid, p, st = action.split("|"); resolve_ticket(s, tid, t_uid)
         render_user_tickets(chat_id, msg_id, uid, s, t_uid, p, "open", notification=f"✅ Ticket #{tid} Resolved!")
+    elif action.startswith("b_sel|") or action.startswith("b_all|"):
+        if not is_admin(uid): return
+        _, s, t_uid = action.split("|"); t_uid = int(t_uid); ids = []
+        if action.startswith("b_all|"):
+            ids = [t['_id'] for t in get_ticket_col(s).find({"user_id": t_uid, "status": "open"}, {"_id": 1}).limit(BULK_MAX)]
+        config = ustate.get('list_config') or {}
+        page = config.get('page', 1) if config.get('slug') == s and config.get('target_uid') == t_uid else 1
+        ustate['bulk'] = {'slug': s, 'target_uid': t_uid, 'ids': ids, 'page': page}
+        render_user_tickets(chat_id, msg_id, uid, s, t_uid, ustate['bulk']['page'], "open")
+    elif action.startswith("b_tog|"):
+        bulk = ustate.get('bulk'); tid = action.split("|", 1)[1]
+        if not bulk: return
+        if tid in bulk['ids']: bulk['ids'].remove(tid)
+        elif len(bulk['ids']) < BULK_MAX: bulk['ids'].append(tid)
+        render_user_tickets(chat_id, msg_id, uid, bulk['slug'], bulk['target_uid'], bulk['page'], "open")
+    elif action == "b_off":
+        bulk = ustate.pop('bulk', None)
+        if bulk: render_user_tickets(chat_id, msg_id, uid, bulk['slug'], bulk['target_uid'], bulk['page'], "open")
+    elif action == "b_res":
+        bulk = ustate.pop('bulk', None)
+        if not bulk or not is_admin(uid): return
+        n, _ = resolve_tickets(bulk['slug'], bulk['target_uid'], bulk['ids'])
+        render_user_tickets(chat_id, msg_id, uid, bulk['slug'], bulk['target_uid'], bulk['page'], "open", notification=f"✅ {n} Tickets Resolved!")
+    elif action == "b_rep":
+        bulk = ustate.get('bulk')
+        if not bulk or not bulk['ids']: return
+        ustate.update({'state': 'bulk_reply', 'slug': bulk['slug'], 'target_uid': bulk['target_uid'], 'page': bulk['page'], 'status': 'open', 'chat_id': chat_id, 'msg_id': msg_id, 'time': time.time()})
+        smart_edit(chat_id, msg_id, f"📝 *Reply to {len(bulk['ids'])} tickets, then resolve them*...", reply_markup=types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("❌ Cancel", callback_data="b_cancel")))
+    elif action == "b_cancel":
+        for k in ('state', 'slug', 'target_uid', 'page', 'status', 'chat_id', 'msg_id', 'time'): ustate.pop(k, None)
+        bulk = ustate.get('bulk')
+        if bulk: render_user_tickets(chat_id, msg_id, uid, bulk['slug'], bulk['target_uid'], bulk['page'], "open")
     elif action.startswith("self_res|"):
-        _, s, tid = action.split("|"); col = get_ticket_col(s)
-        col.update_one({"_id": tid}, {"$set": {"status": "resolved", "resolved_at": datetime.now()}})
+        _, s, tid = action.split("|"); resolve_ticket(s, tid, uid)
         render_self_tickets(chat_id, msg_id, uid, 1, "open")
     elif action.startswith("t_rep|"):
         _, s, tid, t_uid, p, st = action.split("|")
-        user_states[uid].update({'state': 'admin_reply', 'tid': tid, 'slug': s, 'target_uid': int(t_uid), 'page': p, 'status': st, 'chat_id': chat_id, 'msg_id': msg_id, 'time': time.time()})
+        ustate.update({'state': 'admin_reply', 'tid': tid, 'slug': s, 'target_uid': int(t_uid), 'page': p, 'status': st, 'chat_id': chat_id, 'msg_id': msg_id, 'time': time.time()})
         smart_edit(chat_id, msg_id, f"📝 *Replying to #{tid}*...", reply_markup=types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("❌ Cancel", callback_data="cancel_reply")))
     elif action == "cancel_reply":
         state = user_states.pop(uid, None)
-        if state: render_ticket_view(chat_id, msg_id, state['slug'], state['tid'], state['target_uid'], state['page'], state['status'])
+        if state: render_ticket_view(chat_id, msg_id, state['slug'], state['tid'], state['target_uid'], state['page'], state['status'], uid=uid)
     elif action.startswith("u_rep|"):
         _, s, tid = action.split("|")
-        user_states[uid].update({'state': 'user_reply', 'tid': tid, 'slug': s, 'chat_id': chat_id, 'msg_id': msg_id, 'time': time.time()})
+        ustate.update({'state': 'user_reply', 'tid': tid, 'slug': s, 'chat_id': chat_id, 'msg_id': msg_id, 'time': time.time()})
         smart_edit(chat_id, msg_id, f"📝 *Replying to Admin (#{tid})*...", reply_markup=types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("❌ Cancel", callback_data="cancel_user_reply")))
     elif action == "cancel_user_reply":
         state = user_states.pop(uid, None)
         if state: render_self_view(chat_id, msg_id, uid, state['slug'], state['tid'])
     elif action.startswith("cat|"):
-        user_states[uid] = {'state': 'waiting', 'slug': action.split("|")[1], 'time': time.time()}
-        smart_edit(chat_id, msg_id, f"📝 *Category: {user_states[uid]['slug'].upper()}*\nPlease describe your issue:", reply_markup=types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("🔙 Cancel", callback_data="user_start")))
+        slug = action.split("|")[1]; user_states[uid] = {'state': 'waiting', 'slug': slug, 'time': time.time()}
+        smart_edit(chat_id, msg_id, f"📝 *Category: {slug.upper()}*\nPlease describe your issue:", reply_markup=types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("🔙 Cancel", callback_data="user_start")))
     elif action == "user_start":
         user_states.pop(uid, None); render_main_menu(chat_id, msg_id, uid)
 
 # --- HANDLERS ---
 @bot.message_handler(commands=['start'])
+@metrics.action("/start")
 def start(message):
     render_main_menu(message.chat.id, None, message.from_user.id)
 
 @bot.message_handler(commands=['check'])
+@metrics.action("/check")
 def check_cmd(message): render_self_tickets(message.chat.id, None, message.from_user.id, 1, "open")
 
+@bot.message_handler(commands=['stats'])
+def stats_cmd(message):
+    if not is_admin(message.from_user.id): return
+    bot.send_message(message.chat.id, stats_text())
+
+@bot.message_handler(commands=['search'])
+@metrics.action("/search")
+def search_cmd(message):
+    uid = message.from_user.id
+    if not is_admin(uid): return
+    q = "".join((message.text or "").split(maxsplit=1)[1:]).replace("`", "").strip()[:100]
+    if not q: bot.send_message(message.chat.id, "🔎 Usage: `/search <ticket id, username or text>`"); return
+    user_state(uid)['search'] = q
+    process_action("srch|1", uid, message.chat.id, None, None)
+
+# Callback prefixes process_action knows; anything else is recorded as "other" so forged
+# callback data cannot add metric series.
+ROUTER_ACTIONS = {"t_menu", "close_menu", "page_list", "adm_cat", "u_list", "u_tix", "self_tix", "self_view", "nav_back",
+                  "t_view", "srch", "h_win", "v_med", "v_all_med", "t_res", "self_res", "t_rep", "cancel_reply", "u_rep",
+                  "cancel_user_reply", "cat", "user_start", "b_sel", "b_all", "b_tog", "b_off", "b_res", "b_rep", "b_cancel", "ignore"}
+
 @bot.callback_query_handler(func=lambda c: True)
 def router(call):
-    bot.answer_callback_query(call.id); process_action(call.data, call.from_user.id, call.message.chat.id, call.message.message_id, call.id)
+    name = call.data.split("|")[0]
+    with metrics.action(name if name in ROUTER_ACTIONS else "other"):
+        bot.answer_callback_query(call.id); process_action(call.data, call.from_user.id, call.message.chat.id, call.message.message_id, call.id)
 
 @bot.message_handler(content_types=['text', 'photo', 'video'])
+@metrics.action("message")
 def handle_all(message):
     uid = message.from_user.id; state = user_states.get(uid)
     if state and time.time() - state.get('time', 0) > 180: user_states.pop(uid, None); state = None
-    if not state: return
+    if not state or not state.get('state'): return
     try:
         col = get_ticket_col(state['slug'])
         if state['state'] == 'waiting':
-            counter = settings_col.find_one_and_update({"_id": "ticket_counter"}, {"$inc": {"count": 1}}, upsert=True, return_document=pymongo.ReturnDocument.AFTER)
-            tid = f"{(message.from_user.username or 'user').split('_')[0]}/{counter['count']}"
-            ticket = {'_id': tid, 'user_id': uid, 'name': message.from_user.first_name, 'username': message.from_user.username, 'text': message.text or message.caption or "[Media]", 'status': 'open', 'created_at': datetime.now(), 'history': []}
+            tid = f"{(message.from_user.username or 'user').split('_')[0]}/{ticket_ids.take()}"
+            ticket = {'_id': tid, 'user_id': uid, 'name': message.from_user.first_name, 'username': message.from_user.username, 'text': message.text or message.caption or "[Media]", 'status': 'open', 'created_at': datetime.now(), 'history': [], 'history_len': 0}
             if message.photo: ticket['photo'] = message.photo[-1].file_id
             elif message.video: ticket['video'] = message.video.file_id
-            col.insert_one(ticket); bot.reply_to(message, f"✅ *Ticket Created: #{tid}*")
-            for adm in ADMIN_LIST: bot.send_message(adm, f"⚠️ *New Ticket #{tid}*", reply_markup=types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("📂 View", callback_data=f"t_view|{state['slug']}|{tid}|{uid}|1|open")))
+            ticket['media'] = [m for m in [media_entry(0, ticket)] if m]
+            col.insert_one(ticket); touch_user_summary(state['slug'], uid, opened=1, name=ticket['name'], username=ticket['username'])
+            invalidate_counts(("tix", state['slug'], uid, "open"), ("users", state['slug']))
+            render_cache.invalidate(("u", state['slug'], uid), ("self", uid))
+            bot.reply_to(message, f"✅ *Ticket Created: #{tid}*")
+            # Keyed per admin, so new tickets that pile up behind a backlog go out as one digest.
+            for adm in ADMIN_LIST: outbox.send("send_message", adm, f"⚠️ *New Ticket #{tid}*", reply_markup=types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("📂 View", callback_data=f"t_view|{state['slug']}|{tid}|{uid}|1|open")), key="new")
             user_states.pop(uid, None)
         elif state['state'] in ['admin_reply', 'user_reply']:
-            t = col.find_one({"_id": state['tid']}); idx = len(t.get('history', [])) + 1
+            idx = next_history_index(col, state['tid'])
+            if idx is None: user_states.pop(uid, None); return
             reply = {'role': 'admin' if state['state'] == 'admin_reply' else 'user', 'text': message.text or message.caption or "[Media]", 'time': datetime.now(), 'index': idx}
             if message.photo: reply['photo'] = message.photo[-1].file_id
             elif message.video: reply['video'] = message.video.file_id
-            col.update_one({"_id": state['tid']}, {"$push": {"history": reply}})
+            push = {"history": reply}; entry = media_entry(idx, reply)
+            if entry: push["media"] = entry
+            col.update_one({"_id": state['tid']}, {"$push": push, "$set": {"last_role": reply['role']}})
+            touch_user_summary(state['slug'], state['target_uid'] if state['state'] == 'admin_reply' else uid)
+            render_cache.invalidate(("t", state['slug'], state['tid']))
             if state['state'] == 'admin_reply':
                 target_uid = state['target_uid']
                 kb = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("📩 Reply to Admin", callback_data=f"u_rep|{state['slug']}|{state['tid']}"))
-                try:
-                    if message.photo: bot.send_photo(target_uid, message.photo[-1].file_id, caption=f"👨‍💻 *Admin Reply (#{state['tid']}):*\n{reply['text']}", reply_markup=kb)
-                    elif message.video: bot.send_video(target_uid, message.video.file_id, caption=f"👨‍💻 *Admin Reply (#{state['tid']}):*\n{reply['text']}", reply_markup=kb)
-                    else: bot.send_message(target_uid, f"👨‍💻 *Admin Reply (#{state['tid']}):*\n{reply['text']}", reply_markup=kb)
-                except: pass
+                notify(target_uid, message, f"👨‍💻 *Admin Reply (#{state['tid']}):*\n{reply['text']}", reply_markup=kb, key=("reply", state['tid']))
                 render_user_tickets(state['chat_id'], state['msg_id'], uid, state['slug'], target_uid, state['page'], state['status'], notification=f"✅ Reply Sent to User for #{state['tid']}!")
             else:
-                for adm in ADMIN_LIST: 
-                    kb = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("📂 View", callback_data=f"t_view|{state['slug']}|{state['tid']}|{uid}|1|open"))
-                    try:
-                        if message.photo: bot.send_photo(adm, message.photo[-1].file_id, caption=f"📩 *User Reply (#{state['tid']}):*\n{reply['text']}", reply_markup=kb)
-                        elif message.video: bot.send_video(adm, message.video.file_id, caption=f"📩 *User Reply (#{tid}):*\n{reply['text']}", reply_markup=kb)
-                        else: bot.send_message(adm, f"📩 *User Reply (#{state['tid']}):*\n{reply['text']}", reply_markup=kb)
-                    except: pass
+                kb = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("📂 View", callback_data=f"t_view|{state['slug']}|{state['tid']}|{uid}|1|open"))
+                for adm in ADMIN_LIST: notify(adm, message, f"📩 *User Reply (#{state['tid']}):*\n{reply['text']}", reply_markup=kb, key=("reply", state['tid']))
                 smart_edit(state['chat_id'], state['msg_id'], f"✅ *Reply sent for #{state['tid']}!*")
             user_states.pop(uid, None)
-            try: bot.delete_message(message.chat.id, message.message_id)
-            except: pass
-    except: traceback.print_exc()
+            outbox.send("delete_message", message.chat.id, message.message_id)
+        elif state['state'] == 'bulk_reply':
+            reply = {'role': 'admin', 'text': message.text or message.caption or "[Media]", 'time': datetime.now()}
+            if message.photo: reply['photo'] = message.photo[-1].file_id
+            elif message.video: reply['video'] = message.video.file_id
+            n, tids = resolve_tickets(state['slug'], state['target_uid'], (state.pop('bulk', None) or {}).get('ids', []), reply)
+            if n:
+                # One message for the whole batch instead of one per ticket.
+                shown = ", ".join(f"#{t}" for t in tids[:10]) + (f" (+{len(tids) - 10} more)" if len(tids) > 10 else "")
+                notify(state['target_uid'], message, f"👨‍💻 *Admin Reply ({shown}):*\n{reply['text']}\n\n✅ Marked as resolved.", key=("bulk", message.message_id))
+            render_user_tickets(state['chat_id'], state['msg_id'], uid, state['slug'], state['target_uid'], state['page'], "open", notification=f"✅ Replied to and resolved {n} tickets!")
+            user_states.pop(uid, None)
+            outbox.send("delete_message", message.chat.id, message.message_id)
+    except: metrics.incr(("errors", "handle_all")); traceback.print_exc()
+
+# --- WEBHOOK ---
+# With WEBHOOK_URL set the bot registers a webhook and serves it from an embedded asyncio HTTP
+# server instead of long polling. Each POST is acknowledged as soon as the update is queued on
+# the dispatcher; a full queue answers 503 so Telegram retries later. Terminate TLS in front of
+# it, or point WEBHOOK_CERT/WEBHOOK_KEY at a certificate. Requests without the secret token
+# are refused; without WEBHOOK_SECRET a random one is registered. replay_update.py posts the
+# recorded updates under fixtures/ to a running instance.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_CERT = os.getenv("WEBHOOK_CERT")
+WEBHOOK_KEY = os.getenv("WEBHOOK_KEY")
+WEBHOOK_MAX_BODY = 1 << 20
+WEBHOOK_READ_TIMEOUT = 10
+
+async def read_request(reader):
+    method, path, _ = (await reader.readline()).decode().split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""): break
+        k, _, v = line.decode().partition(":"); headers[k.strip().lower()] = v.strip()
+    return method, path, headers
+
+async def handle_webhook(reader, writer):
+    try:
+        method, path, headers = await asyncio.wait_for(read_request(reader), WEBHOOK_READ_TIMEOUT)
+        length = int(headers.get("content-length", 0))
+        if path != (urlparse(WEBHOOK_URL or "").path or "/"): status = HTTPStatus.NOT_FOUND
+        elif method != "POST": status = HTTPStatus.METHOD_NOT_ALLOWED
+        elif not WEBHOOK_SECRET or not hmac.compare_digest(headers.get("x-telegram-bot-api-secret-token", ""), WEBHOOK_SECRET): status = HTTPStatus.UNAUTHORIZED
+        elif length > WEBHOOK_MAX_BODY: status = HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+        else:
+            body = await asyncio.wait_for(reader.readexactly(length), WEBHOOK_READ_TIMEOUT)
+            update = types.Update.de_json(body.decode())
+            status = HTTPStatus.OK if dispatcher.submit(update, block=False) else HTTPStatus.SERVICE_UNAVAILABLE
+    except Exception as e:
+        print(f"⚠️ Bad webhook request: {e}"); status = HTTPStatus.BAD_REQUEST
+    extra = "Retry-After: 1\r\n" if status == HTTPStatus.SERVICE_UNAVAILABLE else ""
+    writer.write(f"HTTP/1.1 {status.value} {status.phrase}\r\nContent-Length: 0\r\n{extra}Connection: close\r\n\r\n".encode())
+    try: await writer.drain()
+    finally: writer.close()
+
+async def serve_webhook():
+    ctx = None
+    if WEBHOOK_CERT:
+        ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH); ctx.load_cert_chain(WEBHOOK_CERT, WEBHOOK_KEY)
+    server = await asyncio.start_server(handle_webhook, WEBHOOK_HOST, WEBHOOK_PORT, ssl=ctx)
+    print(f"🌐 Webhook listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}")
+    async with server: await server.serve_forever()
+
+def run_webhook():
+    # Every update must carry the secret: the handlers trust from_user.id for admin checks.
+    global WEBHOOK_SECRET
+    if not WEBHOOK_SECRET:
+        WEBHOOK_SECRET = secrets.token_urlsafe(32); print("🔑 No WEBHOOK_SECRET set, using a random one for this run")
+    bot.remove_webhook()
+    bot.set_webhook(WEBHOOK_URL, certificate=open(WEBHOOK_CERT, "rb") if WEBHOOK_CERT else None, secret_token=WEBHOOK_SECRET)
+    asyncio.run(serve_webhook())
+
+# --- MAINTENANCE ---
+# Usage: python main.py <command>
+COMMANDS = {
+    "check-indexes": verify_indexes,
+    "rebuild-summaries": rebuild_user_summaries,
+    "backfill": backfill_tickets,
+    "archive": archive_resolved,
+}
+
+def run_command(name):
+    if name not in COMMANDS:
+        print(f"Unknown command '{name}'. Available: {', '.join(COMMANDS)}"); return 2
+    if not db_ready.wait(30):
+        print("❌ Database not available"); return 1
+    return 0 if COMMANDS[name]() else 1
+
+# Connect once every helper above exists; index setup runs as soon as the ping succeeds.
+threading.Thread(target=connect_db, daemon=True).start()
 
 if __name__ == "__main__":
-    bot.remove_webhook(); bot.infinity_polling(timeout=60)
+    if len(sys.argv) > 1: sys.exit(run_command(sys.argv[1]))
+    if METRICS_PORT: start_metrics_server()
+    if WEBHOOK_URL: run_webhook()
+    else: bot.remove_webhook(); bot.infinity_polling(timeout=60)
@@ -0,0 +1,44 @@
+# Posts recorded updates to a running webhook instance, the way Telegram would, and prints the
+# status code. With --check it also sends a wrong secret, a wrong path, a GET and a broken body
+# and fails unless they are refused with 401/404/405/400.
+#
+#   WEBHOOK_URL=https://bot.example.com/tg WEBHOOK_SECRET=... python main.py &
+#   WEBHOOK_URL=https://bot.example.com/tg WEBHOOK_SECRET=... python replay_update.py fixtures/*.json --check
+import os
+import sys
+import argparse
+from urllib.error import HTTPError
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
+
+def post(url, body, secret, method="POST"):
+    headers = {"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secret}
+    try:
+        with urlopen(Request(url, data=body if method == "POST" else None, headers=headers, method=method), timeout=10) as r: return r.status
+    except HTTPError as e: return e.code
+
+if __name__ == "__main__":
+    path = urlparse(os.getenv("WEBHOOK_URL", "")).path or "/"
+    ap = argparse.ArgumentParser()
+    ap.add_argument("fixtures", nargs="+", help="recorded update JSON files")
+    ap.add_argument("--url", default=f"http://127.0.0.1:{os.getenv('WEBHOOK_PORT', '8443')}{path}", help="where the webhook server listens")
+    ap.add_argument("--secret", default=os.getenv("WEBHOOK_SECRET", ""))
+    ap.add_argument("--check", action="store_true", help="also verify that bad requests are refused")
+    args = ap.parse_args()
+    if not args.secret: sys.exit("set WEBHOOK_SECRET (or --secret) to the secret the bot runs with")
+
+    failed = 0
+    for name in args.fixtures:
+        with open(name, "rb") as f: body = f.read()
+        status = post(args.url, body, args.secret); failed += status != 200
+        print(f"{status} {name}")
+    if args.check:
+        body = open(args.fixtures[0], "rb").read()
+        other = args.url.rstrip("/") + "/nope"
+        for label, want, status in [("wrong secret", 401, post(args.url, body, args.secret + "x")),
+                                    ("wrong path", 404, post(other, body, args.secret)),
+                                    ("GET", 405, post(args.url, None, args.secret, method="GET")),
+                                    ("broken body", 400, post(args.url, b"{not json", args.secret))]:
+            failed += status != want
+            print(f"{status} {label} (want {want})")
+    sys.exit(1 if failed else 0)